@@ -0,0 +1,113 @@
+"""Ограничение параллельных запросов к тяжёлым обработчикам.
+
+Каждый обработчик держит не больше одного соединения из пула (см. Session),
+поэтому лимиты обработчиков ограничивают и долю пула, которую они могут занять.
+Кроме своего лимита, каждый тяжёлый запрос занимает место в общем лимите heavy,
+который меньше пула на DB_POOL_RESERVED: остальным обработчикам соединения
+достаются без очереди. Сверх лимита запрос ждёт
+не дольше ADMISSION_TIMEOUT, при переполненной очереди - отказ сразу, в обоих
+случаях 503 с Retry-After. Лимиты свои у каждого воркера.
+"""
+import asyncio
+from contextvars import ContextVar
+from typing import Optional
+
+from app.db.db import DB
+from app.exceptions import ServiceUnavailable
+from app.settings import NODES_CONCURRENCY, STATISTIC_CONCURRENCY, SALES_CONCURRENCY, HEAVY_CONCURRENCY
+from app.settings import ADMISSION_QUEUE_SIZE, ADMISSION_TIMEOUT, ADMISSION_RETRY_AFTER
+
+
+class Limiter:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit) if limit else None
+        self.waiting = 0
+        self.rejected = 0
+
+    def overloaded(self) -> ServiceUnavailable:
+        self.rejected += 1
+        return ServiceUnavailable(f'Сервер перегружен ({self.name}), повторите позже', retry_after=ADMISSION_RETRY_AFTER)
+
+    def full(self) -> bool:
+        return self.semaphore is not None and self.semaphore.locked()
+
+    async def acquire(self) -> None:
+        if self.semaphore is None:
+            return
+        if self.full() and self.waiting >= ADMISSION_QUEUE_SIZE:
+            raise self.overloaded()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), ADMISSION_TIMEOUT or None)
+        except asyncio.TimeoutError:
+            raise self.overloaded() from None
+        finally:
+            self.waiting -= 1
+
+    def release(self) -> None:
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+limiters = {
+    'nodes': Limiter('nodes', NODES_CONCURRENCY),
+    'statistic': Limiter('statistic', STATISTIC_CONCURRENCY),
+    'sales': Limiter('sales', SALES_CONCURRENCY),
+    # Общий для всех трёх: сумма их лимитов может быть больше пула
+    'heavy': Limiter('heavy', HEAVY_CONCURRENCY),
+}
+
+
+class Admission:
+    """Места в лимитах, занятые обработчиком до отправки ответа"""
+
+    def __init__(self):
+        self.held: list[Limiter] = []
+
+    async def enter(self, limiter: Limiter) -> None:
+        await limiter.acquire()
+        self.held.append(limiter)
+
+    def close(self) -> None:
+        while self.held:
+            self.held.pop().release()
+
+
+# Места текущего обработчика (см. admission_scope)
+_admission: ContextVar[Optional[Admission]] = ContextVar('admission', default=None)
+
+
+async def admit(name: str) -> None:
+    """Занимает место в лимите обработчика name до конца ответа, в том числе потокового"""
+    admission = _admission.get()
+    if admission is None:
+        raise RuntimeError('admit вызван вне admission_scope')
+    for limiter in (limiters[name], limiters['heavy']):
+        if limiter.full():
+            # В очереди соединение из пула не нужно: иначе ждущие запросы выберут весь пул
+            await DB.release_session()
+        await admission.enter(limiter)
+
+
+async def admission_scope():
+    """Зависимость FastAPI: освобождает занятые через admit места после отправки ответа"""
+    admission = Admission()
+    token = _admission.set(admission)
+    try:
+        yield
+    finally:
+        _admission.reset(token)
+        admission.close()
+
+
+def admission_stats() -> dict[str, dict[str, int]]:
+    return {
+        name: {
+            'limit': limiter.limit,
+            'waiting': limiter.waiting,
+            'rejected': limiter.rejected,
+        }
+        for name, limiter in limiters.items()
+    }
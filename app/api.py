@@ -1,21 +1,52 @@
+import asyncio
 import logging
+from contextlib import suppress
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
+from app.admission import admission_stats
+from app.cache import cache
+from app.conditional import NotModified
 from app.db.db import DB
+from app.db.maintenance import maintenance_loop
+from app.db.migrate import migrate
+from app.jobs import import_queue
+from app.offload import tree_offload
+from app.metrics import MetricsMiddleware, render_metrics, wait_idle
 from app.exceptions import CommonException, InternalServerError, BadRequest, NotFoundException
 from app.models import ValidationError, NotFoundError, SuccessfullResponse
 from app.routers.items import basic_router, additional_router
+from app.settings import MIGRATE_ON_STARTUP, SNAPSHOT_RETENTION_DAYS, SNAPSHOT_COMPACT_AFTER_DAYS, SHUTDOWN_TIMEOUT
 
 app = FastAPI(title='Mega Market Open API', description='Вступительное задание в Летнюю Школу Бэкенд Разработки Яндекса 2022')
+app.add_middleware(MetricsMiddleware)
 logger = logging.getLogger(__name__)
+background_tasks: list[asyncio.Task] = []
 
 @app.on_event('startup')
 async def startup() -> None:
-    await DB.connect_db()
+    await DB.connect_with_retry()
+    if MIGRATE_ON_STARTUP:
+        async with DB.acquire() as con:
+            await migrate(con)
+    await cache.connect()
+    import_queue.start()
+    await tree_offload.start()
+    if SNAPSHOT_RETENTION_DAYS or SNAPSHOT_COMPACT_AFTER_DAYS:
+        background_tasks.append(asyncio.create_task(maintenance_loop()))
 
 @app.on_event('shutdown')
 async def shutdown() -> None:
+    # uvicorn уже не принимает новые соединения: дожидаемся начатых запросов и очереди импортов
+    if not await wait_idle(SHUTDOWN_TIMEOUT):
+        logger.warning('Остановка: не все запросы завершились за %s с', SHUTDOWN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await import_queue.stop(SHUTDOWN_TIMEOUT)
+    tree_offload.stop()
+    await cache.disconnect()
     await DB.disconnect_db()
 
 @app.exception_handler(CommonException)
@@ -26,7 +57,17 @@ async def common_exception_handler(request: Request, exception: CommonException)
         content={
             'code': exception.code,
             'message': exception.error
-        }
+        },
+        headers=exception.headers
     )
+
+@app.exception_handler(NotModified)
+async def not_modified_handler(request: Request, exception: NotModified):
+    return Response(status_code=304, headers=exception.headers)
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics() -> Response:
+    return Response(render_metrics(cache.stats(), admission_stats()), media_type='text/plain; version=0.0.4')
+
 app.include_router(basic_router)
 app.include_router(additional_router)
\ No newline at end of file
@@ -0,0 +1,22 @@
+import logging
+
+from app.cache.backends import CacheBackend, MemoryBackend, NullBackend, RedisBackend
+from app.settings import CACHE_BACKEND, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_REDIS_URL, CACHE_TTL, WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def create_cache() -> CacheBackend:
+    if CACHE_BACKEND == 'redis':
+        return RedisBackend(CACHE_REDIS_URL, ttl=CACHE_TTL)
+    if CACHE_BACKEND == 'memory':
+        if WORKERS > 1 and not CACHE_REDIS_URL:
+            # Без рассылки инвалидаций воркеры отдавали бы устаревшие ответы из своих кэшей
+            logger.warning('Кэш в памяти без CACHE_REDIS_URL отключён: воркеров %s', WORKERS)
+            return NullBackend()
+        return MemoryBackend(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, broadcast_url=CACHE_REDIS_URL)
+    return NullBackend()
+
+
+# Ответы /nodes/{id} и /node/{id}/statistic
+cache = create_cache()
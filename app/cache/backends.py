@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import uuid
+from collections import defaultdict
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+
+from app.cache.lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+
+def redis_from_url(url: str):
+    # aioredis 2 не импортируется на Python 3.11+, там тот же API есть в redis.asyncio
+    try:
+        import aioredis
+    except (ImportError, TypeError):
+        from redis import asyncio as aioredis
+    return aioredis.from_url(url)
+
+
+class CacheBackend:
+    """Кэш готовых JSON-ответов.
+
+    Каждая запись помечена тегами - UUID элементов, от которых зависит ответ.
+    invalidate сбрасывает все записи с переданными тегами. get возвращает вместе
+    со значением версию кэша: set с устаревшей версией ничего не сохраняет.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get(self, key: str) -> tuple[Optional[bytes], Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, tags: Iterable[Hashable], version: Any) -> None:
+        raise NotImplementedError
+
+    async def invalidate(self, tags: Iterable[Hashable]) -> None:
+        raise NotImplementedError
+
+    async def get_or_render(self, key: str, tags: Iterable[Hashable],
+                            render: Callable[[], Awaitable[bytes]]) -> bytes:
+        value, version = await self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await render()
+        await self.set(key, value, tags, version)
+        return value
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class NullBackend(CacheBackend):
+    async def get(self, key: str) -> tuple[Optional[bytes], Any]:
+        return None, None
+
+    async def set(self, key: str, value: bytes, tags: Iterable[Hashable], version: Any) -> None:
+        pass
+
+    async def invalidate(self, tags: Iterable[Hashable]) -> None:
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """LRU в памяти процесса.
+
+    Если передан broadcast_url (или готовый клиент), инвалидации рассылаются
+    через Redis pub/sub и применяются в кэшах всех остальных воркеров.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int,
+                 broadcast_url: Optional[str] = None, client: Any = None) -> None:
+        super().__init__()
+        self.lru = LRUCache(max_entries, max_bytes, on_evict=self._forget)
+        self.broadcast_url = broadcast_url
+        self._client = client
+        self._listener: Optional[asyncio.Task] = None
+        self._sender = uuid.uuid4().hex
+        self._tag_keys: dict[str, set[str]] = defaultdict(set)
+        self._key_tags: dict[str, set[str]] = {}
+
+    async def connect(self) -> None:
+        if self._client is None and self.broadcast_url:
+            self._client = redis_from_url(self.broadcast_url)
+        if self._client is not None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def disconnect(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener
+        if self._client is not None:
+            await self._client.close()
+
+    async def get(self, key: str) -> tuple[Optional[bytes], Any]:
+        return self.lru.get(key), self.lru.version
+
+    async def set(self, key: str, value: bytes, tags: Iterable[Hashable], version: Any) -> None:
+        if self.lru.set(key, value, version):
+            self._forget(key)
+            self._key_tags[key] = {str(tag) for tag in tags}
+            for tag in self._key_tags[key]:
+                self._tag_keys[tag].add(key)
+
+    async def invalidate(self, tags: Iterable[Hashable]) -> None:
+        tags = [str(tag) for tag in tags]
+        self._invalidate_local(tags)
+        if self._client is not None:
+            message = json.dumps({'sender': self._sender, 'tags': tags})
+            try:
+                await self._client.publish(INVALIDATION_CHANNEL, message)
+            except Exception:
+                logger.exception('Не удалось разослать инвалидацию кэша')
+
+    def stats(self) -> dict:
+        return {**self.lru.stats(), 'hits': self.hits, 'misses': self.misses}
+
+    def _invalidate_local(self, tags: Iterable[str]) -> None:
+        keys = set()
+        for tag in tags:
+            keys |= self._tag_keys.get(tag, set())
+        self.lru.invalidate(keys)
+        for key in keys:
+            self._forget(key)
+
+    def _forget(self, key: Hashable) -> None:
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_keys[tag]
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self._client.pubsub()
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Пока подписки не было, чужие инвалидации могли потеряться
+                self.lru.clear()
+                self._tag_keys.clear()
+                self._key_tags.clear()
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    payload = json.loads(message['data'])
+                    if payload['sender'] != self._sender:
+                        self._invalidate_local(payload['tags'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Канал инвалидаций кэша недоступен, переподключение')
+                await asyncio.sleep(1)
+
+
+class RedisBackend(CacheBackend):
+    """Общий для всех воркеров кэш в Redis.
+
+    Для каждого тега хранится множество ключей записей. Версия - счётчик
+    поколений: invalidate увеличивает его до удаления записей, а set под WATCH
+    отбрасывает значение, если поколение сменилось после get.
+    """
+
+    def __init__(self, url: Optional[str] = None, ttl: int = 3600,
+                 prefix: str = 'cache:', client: Any = None) -> None:
+        super().__init__()
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = client
+        self._generation_key = f'{prefix}generation'
+
+    async def connect(self) -> None:
+        if self._client is None:
+            self._client = redis_from_url(self.url)
+
+    async def disconnect(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+
+    async def get(self, key: str) -> tuple[Optional[bytes], Any]:
+        try:
+            value, version = await self._client.mget(self.prefix + key, self._generation_key)
+        except Exception:
+            logger.exception('Ошибка чтения из кэша')
+            return None, None
+        return value, version
+
+    async def set(self, key: str, value: bytes, tags: Iterable[Hashable], version: Any) -> None:
+        key = self.prefix + key
+        try:
+            async with self._client.pipeline(transaction=True) as pipe:
+                await pipe.watch(self._generation_key)
+                if await pipe.get(self._generation_key) != version:
+                    return
+                pipe.multi()
+                pipe.set(key, value, ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(self._tag_key(tag), key)
+                    pipe.expire(self._tag_key(tag), self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            # WatchError - поколение сменилось, значение могло устареть
+            if type(e).__name__ != 'WatchError':
+                logger.exception('Ошибка записи в кэш')
+
+    async def invalidate(self, tags: Iterable[Hashable]) -> None:
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return
+        try:
+            await self._client.incr(self._generation_key)
+            async with self._client.pipeline(transaction=False) as pipe:
+                for tag_key in tag_keys:
+                    pipe.smembers(tag_key)
+                members = await pipe.execute()
+            await self._client.delete(*set().union(*members), *tag_keys)
+        except Exception:
+            logger.exception('Ошибка инвалидации кэша')
+
+    def _tag_key(self, tag: Hashable) -> str:
+        return f'{self.prefix}tag:{tag}'
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, Optional
+
+
+class LRUCache:
+    """LRU-кэш готовых JSON-ответов с ограничением по числу записей и по объёму в байтах.
+
+    Каждая инвалидация увеличивает version. Значение, посчитанное до инвалидации,
+    не попадёт в кэш: set принимает версию, прочитанную перед походом в базу.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int,
+                 on_evict: Optional[Callable[[Hashable], None]] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: bytes, version: int) -> bool:
+        if version != self.version or len(value) > self.max_bytes or not self.max_entries:
+            return False
+        self._discard(key)
+        self._entries[key] = value
+        self.size += len(value)
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(evicted_key)
+        return key in self._entries
+
+    def invalidate(self, keys: Iterable[Hashable]) -> None:
+        self.version += 1
+        for key in keys:
+            self._discard(key)
+
+    def clear(self) -> None:
+        self.version += 1
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _discard(self, key: Hashable) -> None:
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
@@ -0,0 +1,91 @@
+"""Условные GET для /nodes/{id} и /node/{id}/statistic.
+
+Версия элемента (revision) меняется при любом изменении его поддерева, в том
+числе при удалении потомков, поэтому ETag строится из неё. Last-Modified - дата
+элемента: удаление её не меняет, так что точная проверка - только по If-None-Match.
+
+Заголовки версии хранятся в кэше вместе с телом (pack/unpack): ETag и тело всегда
+из одного чтения, и при попадании в кэш проверка обходится без базы.
+"""
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Optional
+
+from fastapi import Request
+
+
+class NotModified(Exception):
+    """Ответ 304, см. обработчик в app.api"""
+
+    def __init__(self, headers: dict[str, str]) -> None:
+        super().__init__()
+        self.headers = headers
+
+
+def _headers(etag: str, last_modified: Optional[str]) -> dict[str, str]:
+    headers = {
+        'ETag': etag,
+        # Клиент может хранить ответ, но перед использованием обязан его проверить
+        'Cache-Control': 'no-cache',
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = last_modified
+    return headers
+
+
+def version_headers(date: Optional[datetime], *version) -> dict[str, str]:
+    last_modified = format_datetime(date.astimezone(timezone.utc), usegmt=True) if date is not None else None
+    return _headers('"' + '-'.join(map(str, version)) + '"', last_modified)
+
+
+def pack(headers: dict[str, str], body: bytes) -> bytes:
+    """Тело с заголовками версии для кэша: строка ETag, строка Last-Modified, тело"""
+    return f"{headers['ETag']}\n{headers.get('Last-Modified', '')}\n".encode() + body
+
+
+def unpack(value: bytes) -> tuple[dict[str, str], bytes]:
+    etag, last_modified, body = value.split(b'\n', 2)
+    return _headers(etag.decode(), last_modified.decode() or None), body
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Для GET сравнение слабое: W/"1" совпадает с "1"
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def _not_modified_since(header: str, last_modified: Optional[str]) -> bool:
+    if last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return parsedate_to_datetime(last_modified) <= since
+
+
+def _is_fresh(request: Request, headers: dict[str, str]) -> bool:
+    """У клиента актуальная версия. If-Modified-Since учитывается, только если нет
+    If-None-Match (RFC 7232)."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, headers['ETag'])
+    if_modified_since = request.headers.get('if-modified-since')
+    return if_modified_since is not None and _not_modified_since(if_modified_since, headers.get('Last-Modified'))
+
+
+def freshness_check(request: Request) -> Optional[Callable[[dict[str, str]], None]]:
+    """Проверка версии для условного запроса: бросает NotModified, если у клиента
+    актуальная версия. None, если запрос безусловный и проверять нечего."""
+    if 'if-none-match' not in request.headers and 'if-modified-since' not in request.headers:
+        return None
+
+    def check(headers: dict[str, str]) -> None:
+        if _is_fresh(request, headers):
+            raise NotModified(headers)
+    return check
@@ -1,8 +1,24 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+
 import asyncpg
+from fastapi import Request
+from fastapi.routing import APIRoute
+from starlette.responses import StreamingResponse
 from asyncpg.exceptions import PostgresError, UniqueViolationError, ForeignKeyViolationError
 from asyncpg import Record
-from app.settings import DATABASE_URL
-from app.exceptions import InternalServerError
+from app.settings import DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_STATEMENT_CACHE_SIZE
+from app.settings import DB_COMMAND_TIMEOUT, DB_ACQUIRE_TIMEOUT, DB_CONNECT_TIMEOUT, DB_MAX_INACTIVE_LIFETIME
+from app.settings import DB_CONNECT_RETRIES, DB_CONNECT_BACKOFF
+from app.settings import SLOW_QUERY_MS, ADMISSION_RETRY_AFTER
+from app.exceptions import InternalServerError, ServiceUnavailable
+from app.metrics import current_stats
+
+logger = logging.getLogger(__name__)
 
 def exception_wrapper(func):
     async def inner_func(*args, **kwargs):
@@ -14,50 +30,249 @@ def exception_wrapper(func):
             raise
         except PostgresError as e:
             raise InternalServerError(e) from e
+        except asyncio.TimeoutError as e:
+            raise InternalServerError('Превышено время ожидания базы данных') from e
     return inner_func
 
+class Session:
+    """Соединение, закреплённое за обработчиком. Берётся из пула при первом запросе.
+
+    Обработчик держит не больше одного соединения и выполняет на нём не больше
+    одного запроса за раз: параллельные запросы (asyncio.gather) ждут друг друга.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.con: Optional[asyncpg.Connection] = None
+        self.checkout = asyncio.Lock()
+        self.busy = asyncio.Lock()
+
+    async def connection(self) -> asyncpg.Connection:
+        async with self.checkout:
+            if self.con is None:
+                self.con = await DB.acquire_connection()
+        return self.con
+
+    async def close(self) -> None:
+        if self.con is not None:
+            con, self.con = self.con, None
+            await self.pool.release(con)
+
+# Сессия текущего обработчика (см. DB.session)
+_session: ContextVar[Optional[Session]] = ContextVar('db_session', default=None)
+
 class DB:
     pool: asyncpg.Pool = None
+    # Число запросов через DB с запуска процесса (см. benchmarks)
+    queries: int = 0
 
     @classmethod
     async def connect_db(cls) -> None:
         try:
-            cls.pool = await asyncpg.create_pool(DATABASE_URL)
-        except Exception as e:
-            print(e)
+            cls.pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                command_timeout=DB_COMMAND_TIMEOUT or None,
+                max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+                timeout=DB_CONNECT_TIMEOUT,
+            )
+        except (OSError, asyncio.TimeoutError, PostgresError) as e:
+            logger.error('Не удалось подключиться к базе данных: %s', e)
+            raise
 
     @classmethod
-    @exception_wrapper
-    async def execute(cls, sql, *args) -> None:
-        if not cls.pool:
-            await cls.connect_db()
-        async with cls.pool.acquire() as con:
-            return await con.execute(sql, *args)
+    async def connect_with_retry(cls) -> None:
+        # Пул прогревается до приёма запросов: create_pool открывает min_size соединений,
+        # проверочный запрос убеждается, что база отвечает
+        for attempt in range(1, DB_CONNECT_RETRIES + 1):
+            try:
+                await cls.connect_db()
+                await cls.fetchval('select 1')
+                return
+            except (OSError, asyncio.TimeoutError, PostgresError, InternalServerError):
+                await cls.disconnect_db()
+                if attempt == DB_CONNECT_RETRIES:
+                    raise
+                delay = DB_CONNECT_BACKOFF * 2 ** (attempt - 1)
+                logger.warning('База данных недоступна, попытка %s через %.1f с', attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+    @classmethod
+    async def acquire_connection(cls) -> asyncpg.Connection:
+        if cls.pool is None:
+            raise InternalServerError('Нет соединения с базой данных')
+        started = time.perf_counter()
+        try:
+            return await cls.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT or None)
+        except asyncio.TimeoutError as e:
+            raise ServiceUnavailable('Нет свободных соединений с базой данных', retry_after=ADMISSION_RETRY_AFTER) from e
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.pool_wait += time.perf_counter() - started
+
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls):
+        session = _session.get()
+        if session is not None:
+            yield await session.connection()
+            return
+        con = await cls.acquire_connection()
+        try:
+            yield con
+        finally:
+            await cls.pool.release(con)
+
+    @staticmethod
+    @asynccontextmanager
+    async def _query_slot():
+        # Одна операция за раз на соединении сессии; вне сессии у запроса своё соединение
+        session = _session.get()
+        if session is None:
+            yield
+            return
+        async with session.busy:
+            yield
+
+    @classmethod
+    @asynccontextmanager
+    async def session(cls):
+        # Все запросы через DB внутри блока идут по одному соединению.
+        # Соединение берётся из пула только при первом запросе
+        if _session.get() is not None:
+            yield _session.get()
+            return
+        session = Session(cls.pool)
+        token = _session.set(session)
+        try:
+            yield session
+        finally:
+            _session.reset(token)
+            await session.close()
+
+    @staticmethod
+    async def release_session() -> None:
+        # Возвращает соединение сессии в пул, следующий запрос возьмёт его заново
+        session = _session.get()
+        if session is not None:
+            await session.close()
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls, **options):
+        # Единица работы: одно соединение и одна транзакция на весь блок.
+        # options - параметры Connection.transaction: isolation, readonly
+        async with cls.session() as session:
+            con = await session.connection()
+            async with con.transaction(**options):
+                yield con
 
     @classmethod
     @exception_wrapper
+    async def run(cls, method: str, sql: str, *args):
+        async with cls.acquire() as con:
+            started = time.perf_counter()
+            result = None
+            try:
+                async with cls._query_slot():
+                    result = await cls._run(con, method, sql, args)
+                return result
+            finally:
+                if method == 'fetch':
+                    rows = len(result or ())
+                else:
+                    rows = int(method != 'execute' and result is not None)
+                cls._record(sql, time.perf_counter() - started, rows)
+
+    @staticmethod
+    async def _run(con: asyncpg.Connection, method: str, sql: str, args):
+        # Разобранные запросы хранит кэш соединения (statement_cache_size), он живёт
+        # между выдачами соединения из пула
+        return await getattr(con, method)(sql, *args)
+
+    @classmethod
+    def _record(cls, sql: str, elapsed: float, rows: int) -> None:
+        cls.queries += 1
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            stats.rows += rows
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning('Медленный запрос (%.1f мс): %s', elapsed * 1000, ' '.join(sql.split()))
+
+    @classmethod
+    async def execute(cls, sql, *args) -> str:
+        return await cls.run('execute', sql, *args)
+
+    @classmethod
     async def fetch(cls, sql, *args) -> list[Record]:
-        if not cls.pool:
-            await cls.connect_db()
-        async with cls.pool.acquire() as con:
-            return await con.fetch(sql, *args)
+        return await cls.run('fetch', sql, *args)
 
     @classmethod
-    @exception_wrapper
     async def fetchval(cls, sql, *args):
-        if not cls.pool:
-            await cls.connect_db()
-        async with cls.pool.acquire() as con:
-            return await con.fetchval(sql, *args)
+        return await cls.run('fetchval', sql, *args)
 
     @classmethod
-    @exception_wrapper
     async def fetchrow(cls, sql, *args) -> Record:
-        if not cls.pool:
-            await cls.connect_db()
-        async with cls.pool.acquire() as con:
-            return await con.fetchrow(sql, *args)
+        return await cls.run('fetchrow', sql, *args)
+
+    @classmethod
+    async def iterate(cls, sql, *args, prefetch: int = 500) -> AsyncIterator[Record]:
+        # Серверный курсор: в памяти не больше prefetch записей.
+        # В статистику идёт только время чтения курсора, без обработки записей
+        async with cls.acquire() as con:
+            elapsed, rows = 0.0, 0
+            try:
+                async with con.transaction():
+                    cursor = con.cursor(sql, *args, prefetch=prefetch)
+                    records = cursor.__aiter__()
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            # Между порциями курсора обработчик может делать другие запросы
+                            async with cls._query_slot():
+                                record = await records.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            elapsed += time.perf_counter() - started
+                        rows += 1
+                        yield record
+            finally:
+                cls._record(sql, elapsed, rows)
 
     @classmethod
     async def disconnect_db(cls) -> None:
-        await cls.pool.close()
\ No newline at end of file
+        if cls.pool is not None:
+            await cls.pool.close()
+            cls.pool = None
+
+async def db_session():
+    """Зависимость FastAPI: закрепляет соединение за обработчиком до отправки ответа"""
+    async with DB.session():
+        yield
+
+class SessionRoute(APIRoute):
+    """Обработчик, который возвращает соединение сессии в пул, как только готов ответ.
+
+    Зависимости с yield завершаются уже после отправки ответа клиенту: без этого
+    соединение простаивало бы, пока пишется тело. Потоковым ответам оно нужно до конца.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            try:
+                response = await handler(request)
+            except BaseException:
+                await DB.release_session()
+                raise
+            if not isinstance(response, StreamingResponse):
+                await DB.release_session()
+            return response
+        return route_handler
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from app.cache import cache
+from app.db.db import DB
+from app.settings import SNAPSHOT_RETENTION_DAYS, SNAPSHOT_COMPACT_AFTER_DAYS, SNAPSHOT_MAINTENANCE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки на создание и удаление партиций snapshot
+PARTITIONS_LOCK = 2022_0602
+
+# Тег кэша всех ответов /node/{id}/statistic: прореживание и удаление партиций меняют
+# историю, не трогая элементы
+STATISTIC_TAG = 'statistic'
+
+# Партиции, про которые этот процесс уже знает, что они созданы
+_known_partitions: set[str] = set()
+
+
+def month_bounds(date: datetime) -> tuple[datetime, datetime]:
+    start = date.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start, end
+
+def partition_name(start: datetime) -> str:
+    return f'snapshot_{start:%Y_%m}'
+
+
+async def ensure_snapshot_partition(date: Optional[datetime]) -> None:
+    # Вызывается вне транзакции импорта: создание партиции блокирует snapshot целиком
+    if date is None:
+        return
+    start, end = month_bounds(date)
+    name = partition_name(start)
+    if name in _known_partitions:
+        return
+    async with DB.transaction():
+        await DB.execute('select pg_advisory_xact_lock($1)', PARTITIONS_LOCK)
+        sql = """
+            select true from snapshot_partitions
+            where name = $1
+        """
+        if not await DB.fetchval(sql, name):
+            await DB.execute(f"""
+                create table {name} partition of snapshot
+                for values from ('{start.isoformat()}') to ('{end.isoformat()}')
+            """)
+            sql = """
+                insert into snapshot_partitions(name, starts_at, ends_at)
+                values ($1, $2, $3)
+            """
+            await DB.execute(sql, name, start, end)
+    _known_partitions.add(name)
+
+
+async def compact_snapshots(before: datetime) -> int:
+    """Прореживание истории в партициях, целиком лежащих раньше before.
+
+    От каждого элемента остаётся последний снимок за сутки, поэтому состояние
+    на конец любого дня сохраняется. Возвращает число удалённых снимков.
+    """
+    sql = """
+        select name from snapshot_partitions
+        where ends_at <= $1 and not compacted
+        order by starts_at
+    """
+    removed = 0
+    for partition in await DB.fetch(sql, before):
+        name = partition['name']
+        async with DB.transaction():
+            # Партицию может прямо сейчас прореживать другой воркер
+            locked = await DB.fetchval('select pg_try_advisory_xact_lock(hashtext($1))', name)
+            sql = """
+                select compacted from snapshot_partitions
+                where name = $1
+            """
+            if not locked or await DB.fetchval(sql, name) is not False:
+                continue
+            status = await DB.execute(f"""
+                delete from {name} using (
+                    select seq, row_number() over (
+                        partition by id, date_trunc('day', date, 'UTC')
+                        order by date desc, seq desc
+                    ) as rank
+                    from {name}
+                ) as versions
+                where {name}.seq = versions.seq and versions.rank > 1
+            """)
+            sql = """
+                update snapshot_partitions
+                set compacted = true
+                where name = $1
+            """
+            await DB.execute(sql, name)
+        removed += int(status.split()[-1])
+    return removed
+
+
+async def drop_expired_snapshots(before: datetime) -> list[str]:
+    """Удаляет партиции, целиком лежащие раньше before. Возвращает их имена."""
+    async with DB.transaction():
+        await DB.execute('select pg_advisory_xact_lock($1)', PARTITIONS_LOCK)
+        sql = """
+            delete from snapshot_partitions
+            where ends_at <= $1
+            returning name
+        """
+        names = [record['name'] for record in await DB.fetch(sql, before)]
+        for name in names:
+            await DB.execute(f'drop table {name}')
+    _known_partitions.difference_update(names)
+    return names
+
+
+async def drop_expired_offer_updates(before: datetime) -> int:
+    """Удаляет корзины /sales раньше before. Возвращает число удалённых обновлений."""
+    status = await DB.execute('delete from offer_updates where bucket < $1', before)
+    return int(status.split()[-1])
+
+
+async def run_maintenance() -> None:
+    now = datetime.now(timezone.utc)
+    changed = False
+    if SNAPSHOT_RETENTION_DAYS:
+        dropped = await drop_expired_snapshots(now - timedelta(days=SNAPSHOT_RETENTION_DAYS))
+        if dropped:
+            logger.info('Удалены партиции истории: %s', ', '.join(dropped))
+            changed = True
+        await drop_expired_offer_updates(now - timedelta(days=SNAPSHOT_RETENTION_DAYS))
+    if SNAPSHOT_COMPACT_AFTER_DAYS:
+        removed = await compact_snapshots(now - timedelta(days=SNAPSHOT_COMPACT_AFTER_DAYS))
+        if removed:
+            logger.info('Прорежено снимков: %s', removed)
+            changed = True
+    if changed:
+        await cache.invalidate([STATISTIC_TAG])
+
+
+async def maintenance_loop() -> None:
+    while True:
+        try:
+            await run_maintenance()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Ошибка обслуживания истории')
+        await asyncio.sleep(SNAPSHOT_MAINTENANCE_INTERVAL)
+
+
+if __name__ == '__main__':
+    async def main() -> None:
+        await DB.connect_db()
+        # Инвалидации кэша статистики доходят до воркеров через Redis
+        await cache.connect()
+        try:
+            await run_maintenance()
+        finally:
+            await cache.disconnect()
+            await DB.disconnect_db()
+    asyncio.run(main())
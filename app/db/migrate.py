@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from pathlib import Path
+
+import asyncpg
+from app.settings import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+# Ключ advisory-блокировки: воркеры, стартующие одновременно, применяют миграции по очереди
+MIGRATIONS_LOCK = 2022_0601
+
+
+async def migrate(con: asyncpg.Connection) -> list[str]:
+    """Применяет ещё не применённые migrations/*.sql по порядку имён, каждую в своей транзакции"""
+    await con.execute('select pg_advisory_lock($1)', MIGRATIONS_LOCK)
+    try:
+        await con.execute("""
+            create table if not exists schema_migrations
+            (
+                version    text primary key,
+                applied_at timestamp with time zone not null default now()
+            )
+        """)
+        applied = {record['version'] for record in await con.fetch('select version from schema_migrations')}
+        new_versions = []
+        for path in sorted(MIGRATIONS_DIR.glob('*.sql')):
+            if path.stem in applied:
+                continue
+            logger.info('Применение миграции %s', path.stem)
+            async with con.transaction():
+                await con.execute(path.read_text())
+                await con.execute('insert into schema_migrations(version) values ($1)', path.stem)
+            new_versions.append(path.stem)
+        return new_versions
+    finally:
+        await con.execute('select pg_advisory_unlock($1)', MIGRATIONS_LOCK)
+
+
+async def main() -> None:
+    con = await asyncpg.connect(DATABASE_URL)
+    try:
+        for version in await migrate(con):
+            print(version)
+    finally:
+        await con.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,4 +1,3 @@
-create extension if not exists "uuid-ossp";
 create table if not exists shop_units
 (
     id     uuid unique
@@ -19,5 +18,3 @@ create table if not exists snapshot
     date     timestamp with time zone,
     price    integer
 );
-
-
@@ -0,0 +1,60 @@
+-- Сумма цен и число товаров в поддереве категории
+alter table shop_units add column if not exists offers_sum bigint not null default 0;
+alter table shop_units add column if not exists offers_count integer not null default 0;
+-- Агрегаты снимков категорий, сделанных раньше, досчитываются ниже один раз
+alter table snapshot add column if not exists offers_sum bigint;
+alter table snapshot add column if not exists offers_count integer;
+
+with recursive closure(ancestor, id) as (
+    select id, id from shop_units
+    union all
+    select closure.ancestor, shop_units.id from shop_units
+    join closure on shop_units.parentid = closure.id
+),
+totals as (
+    select closure.ancestor as id,
+        coalesce(sum(shop_units.price), 0) as offers_sum,
+        count(shop_units.price) as offers_count
+    from closure
+    join shop_units on shop_units.id = closure.id
+    where shop_units.type = 'OFFER'
+    group by closure.ancestor
+)
+update shop_units
+set offers_sum = totals.offers_sum, offers_count = totals.offers_count
+from totals
+where shop_units.id = totals.id and shop_units.type = 'CATEGORY';
+
+-- Снимок категории: сумма и число товаров её поддерева на момент снимка.
+-- Состояние элемента на момент - его последний снимок не позже этого момента,
+-- поддерево собирается по parentId из этих состояний
+with recursive targets as (
+    select distinct id, date as at from snapshot
+    where type = 'CATEGORY' and offers_sum is null and date is not null
+),
+states as (
+    select distinct on (moments.at, snapshot.id)
+        moments.at, snapshot.id, snapshot.parentId, snapshot.type, snapshot.price
+    from (select distinct at from targets) as moments
+    join snapshot on snapshot.date <= moments.at
+    order by moments.at, snapshot.id, snapshot.date desc
+),
+subtree(at, root, id, type, price) as (
+    select states.at, states.id, states.id, states.type, states.price from states
+    join targets on targets.at = states.at and targets.id = states.id
+    union all
+    select subtree.at, subtree.root, states.id, states.type, states.price from states
+    join subtree on states.at = subtree.at and states.parentid = subtree.id
+),
+totals as (
+    select at, root,
+        coalesce(sum(price) filter (where type = 'OFFER'), 0) as offers_sum,
+        count(price) filter (where type = 'OFFER') as offers_count
+    from subtree
+    group by at, root
+)
+update snapshot
+set offers_sum = totals.offers_sum, offers_count = totals.offers_count
+from totals
+where snapshot.id = totals.root and snapshot.date = totals.at and snapshot.type = 'CATEGORY'
+and snapshot.offers_sum is null;
@@ -0,0 +1,60 @@
+-- История хранится помесячными партициями по date.
+-- Новые партиции создаёт app.db.maintenance.ensure_snapshot_partition перед импортом,
+-- устаревшие прореживаются и удаляются там же.
+set local timezone = 'UTC';
+
+create table if not exists snapshot_partitions
+(
+    name      text primary key,
+    starts_at timestamp with time zone not null,
+    ends_at   timestamp with time zone not null,
+    compacted boolean not null default false
+);
+
+alter table snapshot rename to snapshot_unpartitioned;
+
+-- Без внешних ключей: история удаляется вместе с поддеревом явно (см. delete_shop_unit),
+-- каскад по parentId стирал бы ранние снимки элементов, перенесённых из удаляемой категории
+create table snapshot
+(
+    seq          bigserial,
+    id           uuid,
+    name         text not null,
+    type         text not null,
+    parentId     uuid default null,
+    date         timestamp with time zone,
+    price        integer,
+    offers_sum   bigint,
+    offers_count integer
+) partition by range (date);
+
+-- Сюда попадают только снимки без даты
+create table snapshot_default partition of snapshot default;
+
+create index snapshot_id_date_idx on snapshot (id, date);
+create index snapshot_parentid_date_idx on snapshot (parentId, date);
+
+do $$
+declare
+    month timestamp with time zone;
+    partition_name text;
+begin
+    for month in
+        select distinct date_trunc('month', date) from snapshot_unpartitioned
+        where date is not null
+    loop
+        partition_name := 'snapshot_' || to_char(month, 'YYYY_MM');
+        execute format(
+            'create table %I partition of snapshot for values from (%L) to (%L)',
+            partition_name, month, month + interval '1 month'
+        );
+        insert into snapshot_partitions(name, starts_at, ends_at)
+        values (partition_name, month, month + interval '1 month');
+    end loop;
+end $$;
+
+insert into snapshot(id, name, type, parentId, date, price, offers_sum, offers_count)
+    select id, name, type, parentId, date, price, offers_sum, offers_count from snapshot_unpartitioned
+    order by date;
+
+drop table snapshot_unpartitioned;
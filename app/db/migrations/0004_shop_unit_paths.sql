@@ -0,0 +1,17 @@
+-- Путь от корня до элемента включительно: поддерево и предки читаются одним индексным поиском
+alter table shop_units add column if not exists path uuid[];
+
+with recursive paths(id, path) as (
+    select id, array[id] from shop_units
+    where parentid is null
+    union all
+    select shop_units.id, paths.path || shop_units.id from shop_units
+    join paths on shop_units.parentid = paths.id
+)
+update shop_units
+set path = paths.path
+from paths
+where shop_units.id = paths.id;
+
+alter table shop_units alter column path set not null;
+create index if not exists shop_units_path_idx on shop_units using gin (path);
@@ -0,0 +1,11 @@
+-- Фоновые импорты: статус виден любому воркеру
+create table if not exists import_jobs
+(
+    id         uuid primary key,
+    status     text not null default 'queued',
+    processed  integer not null default 0,
+    total      integer,
+    error      text,
+    created_at timestamp with time zone not null default now(),
+    updated_at timestamp with time zone not null default now()
+);
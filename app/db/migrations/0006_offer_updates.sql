@@ -0,0 +1,19 @@
+-- Обновления товаров по часовым корзинам: /sales читает не больше 25 корзин
+-- вместо просмотра всего каталога и отвечает на любой момент в прошлом
+create table if not exists offer_updates
+(
+    bucket   timestamp with time zone not null,
+    id       uuid not null,
+    name     text not null,
+    parentId uuid,
+    date     timestamp with time zone not null,
+    price    integer,
+    primary key (bucket, id, date)
+);
+
+insert into offer_updates(bucket, id, name, parentId, date, price)
+select distinct on (id, date) date_trunc('hour', date, 'UTC'), id, name, parentId, date, price
+from snapshot
+where type = 'OFFER' and date is not null
+order by id, date, seq desc
+on conflict do nothing;
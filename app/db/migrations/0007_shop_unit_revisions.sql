@@ -0,0 +1,6 @@
+-- Версия элемента для ETag /nodes/{id} и /node/{id}/statistic: новое значение
+-- последовательности при каждом изменении элемента или его поддерева.
+-- Последовательность общая, поэтому версия не повторяется и после удаления и повторного импорта
+create sequence if not exists shop_unit_revisions;
+
+alter table shop_units add column if not exists revision bigint not null default nextval('shop_unit_revisions');
@@ -4,10 +4,14 @@ from fastapi import status
 
 
 class CommonException(Exception):
-    def __init__(self, code: int, error: str) -> None:
+    def __init__(self, code: int, error: str, headers: Optional[Mapping[str, str]] = None,
+                 detail: Optional[str] = None) -> None:
         super().__init__()
         self.error = error
         self.code = code
+        self.headers = headers
+        # Причина для логов и фоновых импортов, когда клиенту отдаётся общее сообщение
+        self.detail = detail or error
 
 class NotFoundException(CommonException):
     def __init__(self, error: str) -> None:
@@ -19,7 +23,12 @@ class InternalServerError(CommonException):
 
 class BadRequest(CommonException):
     def __init__(self, error: str) -> None:
-        super().__init__(status.HTTP_400_BAD_REQUEST, 'Validation Failed')
+        super().__init__(status.HTTP_400_BAD_REQUEST, 'Validation Failed', detail=str(error))
+
+class ServiceUnavailable(CommonException):
+    def __init__(self, error: str, retry_after: Optional[int] = None) -> None:
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+        super().__init__(status.HTTP_503_SERVICE_UNAVAILABLE, error, headers)
 
 class ForbiddenException(CommonException):
     def __init__(self, error: str) -> None:
@@ -0,0 +1,165 @@
+"""Очередь фоновых импортов.
+
+Задача попадает в ограниченную asyncio-очередь того воркера, который её принял,
+и выполняется IMPORT_WORKERS фоновыми задачами. Состояние хранится в import_jobs,
+поэтому опрашивать его можно через любой воркер.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+from contextlib import suppress
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from uuid import UUID, uuid4
+
+import aiofiles
+from fastapi import status
+from pydantic import ValidationError
+
+import app.queries.items as items_queries
+import app.queries.jobs as jobs_queries
+from app.db.db import DB
+from app.exceptions import CommonException, ServiceUnavailable
+from app.models import ImportJobStatus, ShopUnitImport, ShopUnitImportRequest
+from app.settings import IMPORT_WORKERS, IMPORT_QUEUE_SIZE, IMPORT_CHUNK_SIZE, IMPORT_SPOOL_DIR
+
+logger = logging.getLogger(__name__)
+
+# Выполняет импорт и возвращает число импортированных элементов
+JobRunner = Callable[[UUID], Awaitable[int]]
+
+
+class ImportQueue:
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue(IMPORT_QUEUE_SIZE)
+        self.workers = [asyncio.create_task(self._work()) for _ in range(IMPORT_WORKERS)]
+
+    async def stop(self, timeout: float = 0) -> None:
+        # Даём очереди доработать до timeout секунд, потом прерываем
+        if self.queue is not None and timeout:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.queue.join(), timeout)
+        for task in self.workers:
+            task.cancel()
+        for task in self.workers:
+            with suppress(asyncio.CancelledError):
+                await task
+        self.workers = []
+        # Задачи, до которых очередь не дошла, больше не выполнятся
+        while self.queue is not None and not self.queue.empty():
+            job_id, _ = self.queue.get_nowait()
+            await jobs_queries.update_job(job_id, ImportJobStatus.FAILED, error='Сервер остановлен')
+
+    def check_capacity(self) -> None:
+        if self.queue is None or self.queue.full():
+            raise ServiceUnavailable('Очередь импортов заполнена')
+
+    async def submit(self, run: JobRunner, total: Optional[int] = None) -> UUID:
+        self.check_capacity()
+        job_id = uuid4()
+        await jobs_queries.create_job(job_id, total)
+        try:
+            self.queue.put_nowait((job_id, run))
+        except asyncio.QueueFull as e:
+            await jobs_queries.update_job(job_id, ImportJobStatus.FAILED, error='Очередь импортов заполнена')
+            raise ServiceUnavailable('Очередь импортов заполнена') from e
+        return job_id
+
+    async def _work(self) -> None:
+        while True:
+            job_id, run = await self.queue.get()
+            try:
+                await self._run(job_id, run)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job_id: UUID, run: JobRunner) -> None:
+        try:
+            async with DB.session():
+                await jobs_queries.update_job(job_id, ImportJobStatus.RUNNING)
+                processed = await run(job_id)
+                await jobs_queries.update_job(job_id, ImportJobStatus.DONE, processed)
+        except asyncio.CancelledError:
+            await jobs_queries.update_job(job_id, ImportJobStatus.FAILED, error='Импорт прерван остановкой сервера')
+            raise
+        except CommonException as e:
+            await jobs_queries.update_job(job_id, ImportJobStatus.FAILED, error=e.detail)
+        except Exception as e:
+            logger.exception('Ошибка фонового импорта %s', job_id)
+            await jobs_queries.update_job(job_id, ImportJobStatus.FAILED, error=str(e))
+
+
+import_queue = ImportQueue()
+
+
+def request_runner(request: ShopUnitImportRequest) -> JobRunner:
+    async def run(job_id: UUID) -> int:
+        await items_queries.add_shop_units(request)
+        return len(request.items)
+    return run
+
+
+def ndjson_runner(path: str, update_date: datetime) -> JobRunner:
+    """Импорт NDJSON-файла пачками по IMPORT_CHUNK_SIZE, каждая в своей транзакции.
+
+    Родитель должен встретиться в файле раньше потомка или в той же пачке.
+    Пачки, импортированные до ошибки, остаются в базе. Файл удаляется после импорта.
+    В ошибке задачи указываются номера строк файла.
+    """
+    async def import_chunk(job_id: UUID, chunk: list[ShopUnitImport], lines: tuple[int, int], processed: int) -> int:
+        # Элементы уже проверены построчно, повторная валидация пачки не нужна
+        try:
+            await items_queries.add_shop_units(ShopUnitImportRequest.construct(items=chunk, updateDate=update_date))
+        except CommonException as e:
+            raise CommonException(e.code, f'Строки {lines[0]}-{lines[1]}: {e.detail}') from e
+        processed += len(chunk)
+        await jobs_queries.update_job(job_id, ImportJobStatus.RUNNING, processed)
+        return processed
+
+    async def run(job_id: UUID) -> int:
+        processed = 0
+        try:
+            async with aiofiles.open(path, 'rb') as file:
+                chunk = []
+                first_line = last_line = line_number = 0
+                async for line in file:
+                    line_number += 1
+                    if not line.strip():
+                        continue
+                    try:
+                        item = ShopUnitImport.parse_raw(line)
+                    except ValidationError as e:
+                        raise CommonException(status.HTTP_400_BAD_REQUEST, f'Строка {line_number}: {e}') from e
+                    if not chunk:
+                        first_line = line_number
+                    chunk.append(item)
+                    last_line = line_number
+                    if len(chunk) >= IMPORT_CHUNK_SIZE:
+                        processed = await import_chunk(job_id, chunk, (first_line, last_line), processed)
+                        chunk = []
+                if chunk:
+                    processed = await import_chunk(job_id, chunk, (first_line, last_line), processed)
+            return processed
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+    return run
+
+
+async def spool(stream: AsyncIterator[bytes]) -> str:
+    """Пишет тело запроса во временный файл, не держа его в памяти. Возвращает путь."""
+    fd, path = tempfile.mkstemp(suffix='.ndjson', dir=IMPORT_SPOOL_DIR)
+    os.close(fd)
+    try:
+        async with aiofiles.open(path, 'wb') as file:
+            async for chunk in stream:
+                await file.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
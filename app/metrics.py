@@ -0,0 +1,154 @@
+"""Статистика запросов к базе в рамках HTTP-запроса и метрики в формате Prometheus.
+
+DB складывает в RequestStats текущего запроса число запросов, время в базе,
+ожидание соединения из пула и число строк. MetricsMiddleware отдаёт их в
+заголовке Server-Timing и копит гистограммы для /metrics. Метрики свои у
+каждого воркера.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_time', 'pool_wait', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.rows = 0
+
+    def server_timing(self, total: float) -> str:
+        return (f'db;desc="{self.queries} queries";dur={self.db_time * 1000:.2f}, '
+                f'pool;dur={self.pool_wait * 1000:.2f}, '
+                f'total;dur={total * 1000:.2f}')
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+# Запросы, которые сейчас обрабатываются: при остановке их дожидаются
+_in_flight = 0
+_idle = asyncio.Event()
+_idle.set()
+
+
+def current_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # label -> (счётчики по корзинам, сумма, число наблюдений)
+        self.series: dict[str, list] = {}
+
+    def observe(self, label: str, value: float) -> None:
+        series = self.series.setdefault(label, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for label, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{path="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{path="{label}"}} {total}')
+            lines.append(f'{self.name}_count{{path="{label}"}} {count}')
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Время обработки запроса', LATENCY_BUCKETS)
+db_time = Histogram('db_time_seconds', 'Время запросов к базе за HTTP-запрос', LATENCY_BUCKETS)
+pool_wait = Histogram('db_pool_wait_seconds', 'Ожидание соединения из пула за HTTP-запрос', LATENCY_BUCKETS)
+db_queries = Histogram('db_queries_per_request', 'Число запросов к базе за HTTP-запрос', QUERY_BUCKETS)
+db_rows = Histogram('db_rows_per_request', 'Число строк из базы за HTTP-запрос', ROW_BUCKETS)
+HISTOGRAMS = (request_duration, db_time, pool_wait, db_queries, db_rows)
+
+# Счётчики кэша, остальные его показатели отдаются как gauge
+CACHE_COUNTERS = {'hits', 'misses', 'evictions'}
+
+
+async def wait_idle(timeout: float) -> bool:
+    """Ждёт завершения запросов в обработке. False, если не дождались за timeout."""
+    try:
+        await asyncio.wait_for(_idle.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def render_metrics(cache_stats: dict, admission_stats: dict) -> str:
+    lines = ['# TYPE http_requests_in_flight gauge', f'http_requests_in_flight {_in_flight}']
+    for metric, kind in (('limit', 'gauge'), ('waiting', 'gauge'), ('rejected', 'counter')):
+        name = f'admission_{metric}_total' if kind == 'counter' else f'admission_{metric}'
+        lines.append(f'# TYPE {name} {kind}')
+        for endpoint, stats in sorted(admission_stats.items()):
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[metric]}')
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for key, value in sorted(cache_stats.items()):
+        if key in CACHE_COUNTERS:
+            lines.extend([f'# TYPE cache_{key}_total counter', f'cache_{key}_total {value}'])
+        else:
+            lines.extend([f'# TYPE cache_{key} gauge', f'cache_{key} {value}'])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: заводит RequestStats на запрос, пишет Server-Timing и гистограммы"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        global _in_flight
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started = time.perf_counter()
+        _in_flight += 1
+        _idle.clear()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', stats.server_timing(time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _in_flight -= 1
+            if not _in_flight:
+                _idle.set()
+            _request_stats.reset(token)
+            label = self.route_path(scope)
+            request_duration.observe(label, time.perf_counter() - started)
+            db_time.observe(label, stats.db_time)
+            pool_wait.observe(label, stats.pool_wait)
+            db_queries.observe(label, stats.queries)
+            db_rows.observe(label, stats.rows)
+
+    def route_path(self, scope) -> str:
+        # Шаблон пути, а не сам путь: иначе на каждый id своя серия
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
@@ -23,6 +23,19 @@ class ShopUnitImportRequest(BaseModel):
     items: list[ShopUnitImport] = Field([], title='Импортируемые элементы')
     updateDate: datetime = Field(None, title='Время обновления добавляемых товаров/категорий')
 
+class ImportJobStatus(Enum):
+    QUEUED='queued'
+    RUNNING='running'
+    DONE='done'
+    FAILED='failed'
+
+class ImportJob(BaseModel):
+    id: UUID = Field(..., title='Идентификатор фонового импорта')
+    status: ImportJobStatus = Field(..., title='Состояние импорта')
+    processed: int = Field(0, title='Число импортированных элементов')
+    total: int = Field(None, title='Число элементов в импорте, если известно заранее')
+    error: str = Field(None, title='Причина ошибки')
+
 
 class ShopUnitOutput(BaseModel):
     id: UUID = Field(..., title='Уникальный идентификатор')
@@ -0,0 +1,49 @@
+"""Сборка и сериализация больших деревьев /nodes/{id} в пуле процессов.
+
+Сборка дерева и JSON - чистый Python: на поддереве в десятки тысяч элементов он
+держит цикл событий, и ждут все запросы воркера. Начиная с TREE_OFFLOAD_THRESHOLD
+строк записи превращаются в кортежи и отдаются в ProcessPoolExecutor, который
+возвращает готовые байты. Средние цены категорий уже посчитаны в запросе.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from asyncpg import Record
+
+from app.serializers import encode_tree, encode_tree_rows
+from app.settings import TREE_OFFLOAD_THRESHOLD, TREE_OFFLOAD_WORKERS
+
+
+def _warm_up() -> None:
+    pass
+
+
+class TreeOffload:
+    def __init__(self):
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    async def start(self) -> None:
+        if not TREE_OFFLOAD_THRESHOLD or TREE_OFFLOAD_WORKERS <= 0:
+            return
+        # spawn: fork процесса с открытыми соединениями и потоками ненадёжен
+        self.executor = ProcessPoolExecutor(TREE_OFFLOAD_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        # Процессы запускаются при первой задаче: поднимаем их заранее, а не на первом большом дереве
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _warm_up) for _ in range(TREE_OFFLOAD_WORKERS)))
+
+    def stop(self) -> None:
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    async def encode_tree(self, records: list[Record]) -> bytes:
+        if self.executor is None or len(records) < TREE_OFFLOAD_THRESHOLD:
+            return encode_tree(records)
+        # Record не сериализуется pickle, кортежи - дёшево
+        rows = [tuple(record) for record in records]
+        return await asyncio.get_running_loop().run_in_executor(self.executor, encode_tree_rows, rows)
+
+
+tree_offload = TreeOffload()
@@ -0,0 +1,39 @@
+from datetime import datetime
+from typing import AsyncIterator
+from uuid import UUID
+
+from asyncpg import Record
+from app.db.db import DB
+from app.models import ShopUnitType
+
+
+# Одна запись на каждый момент обновления элемента в полуинтервале [$2, $3)
+VERSIONS_SQL = """
+    select distinct on (date) id, name, type, parentId, date, price, offers_sum, offers_count
+    from snapshot
+    where id = $1 and $2 <= date and date < $3
+    order by date, seq desc
+"""
+
+
+async def get_versions(unit_id: UUID, date_start: datetime, date_end: datetime) -> list[Record]:
+    return await DB.fetch(VERSIONS_SQL, unit_id, date_start, date_end)
+
+
+def with_price(version: Record) -> dict:
+    # Цена категории - по агрегатам снимка, целочисленным делением
+    item = dict(version)
+    if item['type'] == ShopUnitType.CATEGORY.value:
+        item['price'] = item['offers_sum'] // item['offers_count'] if item['offers_count'] else None
+    return item
+
+
+async def get_statistic(unit_id: UUID, date_start: datetime, date_end: datetime) -> list[dict]:
+    return [with_price(version) for version in await get_versions(unit_id, date_start, date_end)]
+
+
+async def iter_statistic(unit_id: UUID, date_start: datetime, date_end: datetime,
+                         chunk_size: int) -> AsyncIterator[dict]:
+    # Версии читаются курсором по chunk_size записей
+    async for version in DB.iterate(VERSIONS_SQL, unit_id, date_start, date_end, prefetch=chunk_size):
+        yield with_price(version)
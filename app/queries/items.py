@@ -1,177 +1,424 @@
 from uuid import UUID
 
+from collections import defaultdict
 from datetime import datetime, timedelta
-from asyncio import gather
+from typing import AsyncIterator, Callable, Iterable, Optional
 from asyncpg import Record
-from asyncpg.exceptions import UniqueViolationError, ForeignKeyViolationError
+from asyncpg.exceptions import ForeignKeyViolationError
+from app.admission import admit
+from app.cache import cache
+from app.conditional import version_headers, pack, unpack
 from app.db.db import DB
+from app.db.maintenance import ensure_snapshot_partition, STATISTIC_TAG
+from app.offload import tree_offload
+from app.queries import history
 from app.exceptions import BadRequest, NotFoundException, InternalServerError
-from app.models import ShopUnitImportRequest, ShopUnitOutput, ShopUnitOutputPlain, ShopUnitType
-from app.utils import format_records, format_record
+from app.models import ShopUnitImportRequest, ShopUnitType
+from app.settings import STREAM_CHUNK_SIZE
+from app.serializers import encode_plain, encode_plain_list
+from app.utils import stream_json_array
 
-# TODO: добавить обновление средней цены категории
-# TODO: обновить цены и парент айди при обновлении
-# TODO: add_shop_units обновляет товары
-# TODO: снапшоты
 # TODO: BadRequest заменить на validation failed
-# TODO: при удалении удаляются и снапшоты
-# TODO: измение типа недопускается при обновлении
-# TODO: проверить уникальность uuid при добавлении
-# TODO: get_snapshots добавить цену
-# TODO: целочисленное деление
-# TODO: проверить является ли родитель категорией
-# TODO: сделать insert ы одним запросом (с проверками не требуется)
 
 # TODO: в README упомянуть что у меня не вылетает ошибки при изменении типа
 
+def _ancestors(unit_id: UUID, parents: dict[UUID, UUID]) -> list[UUID]:
+    chain = []
+    parent_id = parents.get(unit_id)
+    while parent_id:
+        if len(chain) > len(parents):
+            raise BadRequest('Циклическая зависимость')
+        chain.append(parent_id)
+        parent_id = parents.get(parent_id)
+    return chain
+
+def _path(unit_id: UUID, parents: dict[UUID, UUID]) -> list[UUID]:
+    return [*reversed(_ancestors(unit_id, parents)), unit_id]
+
+def _path_literal(path: list[UUID]) -> str:
+    # Пути разной длины не укладываются в uuid[][], поэтому передаются текстом
+    return '{' + ','.join(str(unit_id) for unit_id in path) + '}'
+
+def _offer_contribution(price: int) -> (int, int):
+    if price is None:
+        return 0, 0
+    return price, 1
+
+# Пространство ключей advisory-блокировок поддеревьев (первый ключ из двух)
+SUBTREE_LOCK = 2022_0603
+
+class _SubtreesChanged(Exception):
+    """Транзакция затрагивает деревья, которые не заблокировала заранее"""
+
+    def __init__(self, root_ids: set[UUID]) -> None:
+        super().__init__()
+        self.root_ids = root_ids
+
+async def _lock_subtrees(root_ids: Iterable[UUID]) -> None:
+    # Записи в одно дерево идут по очереди: блокировка корня до конца транзакции.
+    # Все корни берутся одним запросом в одном порядке, поэтому взаимных блокировок нет
+    sql = """
+        select pg_advisory_xact_lock($1, hashtext(id::text))
+        from (select id from unnest($2::uuid[]) as id order by id) as roots
+    """
+    await DB.execute(sql, SUBTREE_LOCK, list(root_ids))
+
+async def _find_roots(unit_ids: list[UUID]) -> set[UUID]:
+    sql = """
+        select path[1] from shop_units
+        where id = any($1::uuid[])
+    """
+    return {record[0] for record in await DB.fetch(sql, unit_ids)}
+
+async def _with_subtree_locks(func, root_ids: set[UUID], *args):
+    # Корни деревьев читаются до транзакции. Если после блокировки оказалось, что
+    # элементы уже в других деревьях, транзакция откатывается и повторяется,
+    # блокируя сразу все найденные деревья
+    while True:
+        try:
+            return await func(*args, root_ids)
+        except _SubtreesChanged as e:
+            root_ids |= e.root_ids
+
 async def add_shop_units(request: ShopUnitImportRequest) -> None:
     # Проверка на уникальные UUID
     items = request.items
-    if len(set(map(lambda x: x.id, items))) != len(list(map(lambda x: x.id, items))):
+    ids = [item.id for item in items]
+    if len(set(ids)) != len(ids):
         raise BadRequest('Уникальные UUID должны быть')
-    unique_parent_ids = set()
-    for item in items:
-        # Проверка на тип родителей
-        sql = """
-            select type from shop_units
-            where id = $1
-        """
-        parent_type = await DB.fetchval(sql, item.parentId)
-        if parent_type and parent_type != ShopUnitType.CATEGORY.value:
-            raise BadRequest('Родитель не типа категории')
-        # Проверка на инвариантность типа
+    if not items:
+        return
+    try:
+        parent_ids = [UUID(item.parentId) if item.parentId else None for item in items]
+    except ValueError as e:
+        raise BadRequest('Некорректный UUID родителя') from e
+    await ensure_snapshot_partition(request.updateDate)
+    root_ids = await _find_roots(ids + [parent_id for parent_id in parent_ids if parent_id])
+    root_ids |= {unit_id for unit_id, parent_id in zip(ids, parent_ids) if not parent_id}
+    ancestor_ids = await _with_subtree_locks(_import_batch, root_ids, request, ids, parent_ids)
+    # Инвалидация после коммита: чтение, начатое раньше, не попадёт в кэш из-за смены версии
+    await cache.invalidate(ids + ancestor_ids)
+
+async def _import_batch(request: ShopUnitImportRequest, ids: list[UUID], parent_ids: list[UUID],
+                        root_ids: set[UUID]) -> list[UUID]:
+    """Импорт пачки в одной транзакции. Возвращает всех затронутых предков."""
+    items = request.items
+    async with DB.transaction():
+        if root_ids:
+            await _lock_subtrees(root_ids)
+        # Элементы пачки, их родители и все предки одним запросом по путям
         sql = """
-            select type from shop_units
-            where id = $1
+            select id, type, parentId, price, offers_sum, offers_count, path from shop_units
+            where id in (
+                select unnest(path) from shop_units
+                where id = any($1::uuid[])
+            )
         """
-        current_type = await DB.fetchrow(sql, item.id)
-        if current_type and current_type != item.type.value:
-            raise BadRequest('Невозможно измененить тип')
-        # Добавление/Обновление
+        records = await DB.fetch(sql, ids + [parent_id for parent_id in parent_ids if parent_id])
+        touched = {record['path'][0] for record in records}
+        touched |= {unit_id for unit_id, parent_id in zip(ids, parent_ids) if not parent_id}
+        if not touched <= root_ids:
+            raise _SubtreesChanged(touched)
+        stored = {record['id']: record for record in records}
+        new_types = {item.id: item.type.value for item in items}
+        for item, parent_id in zip(items, parent_ids):
+            # Проверка на инвариантность типа
+            if item.id in stored and stored[item.id]['type'] != item.type.value:
+                raise BadRequest('Невозможно измененить тип')
+            # Проверка на тип родителей
+            if not parent_id:
+                continue
+            parent_type = new_types.get(parent_id) or (parent_id in stored and stored[parent_id]['type'])
+            if not parent_type:
+                raise BadRequest('Родитель не существует')
+            if parent_type != ShopUnitType.CATEGORY.value:
+                raise BadRequest('Родитель не типа категории')
+
+        # Изменения (сумма цен, число товаров) для каждой категории-предка.
+        # Сначала вычитаем старый вклад элементов пачки из старых предков: идём от глубоких
+        # к мелким, чтобы собственный вклад категории не включал вложенные элементы пачки.
+        old_parents = {unit_id: record['parentid'] for unit_id, record in stored.items()}
+        new_parents = {**old_parents, **dict(zip(ids, parent_ids))}
+        old_chains = {item.id: _ancestors(item.id, old_parents) for item in items if item.id in stored}
+        sum_deltas = defaultdict(int)
+        count_deltas = defaultdict(int)
+        own_totals = {}
+        for unit_id in sorted(old_chains, key=lambda unit_id: len(old_chains[unit_id]), reverse=True):
+            record = stored[unit_id]
+            if record['type'] == ShopUnitType.CATEGORY.value:
+                own_totals[unit_id] = (record['offers_sum'] + sum_deltas[unit_id],
+                                       record['offers_count'] + count_deltas[unit_id])
+                price_sum, price_num = own_totals[unit_id]
+            else:
+                price_sum, price_num = _offer_contribution(record['price'])
+            for ancestor_id in old_chains[unit_id]:
+                sum_deltas[ancestor_id] -= price_sum
+                count_deltas[ancestor_id] -= price_num
+        # Затем добавляем новый вклад к новым предкам
+        for item in items:
+            if item.type == ShopUnitType.CATEGORY:
+                price_sum, price_num = own_totals.get(item.id, (0, 0))
+            else:
+                price_sum, price_num = _offer_contribution(item.price)
+            for ancestor_id in _ancestors(item.id, new_parents):
+                sum_deltas[ancestor_id] += price_sum
+                count_deltas[ancestor_id] += price_num
+        ancestor_ids = list(sum_deltas)
+        new_paths = [_path(unit_id, new_parents) for unit_id in ids]
+        # Категории, сменившие путь: пути их поддеревьев переписываются целиком
+        moved_ids = [
+            unit_id for unit_id, path in zip(ids, new_paths)
+            if unit_id in stored and stored[unit_id]['type'] == ShopUnitType.CATEGORY.value
+            and stored[unit_id]['path'] != path
+        ]
+
+        # Добавление/Обновление всей пачки одним запросом
         sql = """
-            insert into shop_units(id, name, type, parentId, date, price) 
-            values (coalesce($6, uuid_generate_v4()), $1, $2, $3, $4, $5) 
-            on conflict (id) do update 
+            insert into shop_units(id, name, type, parentId, date, price, path)
+            select id, name, type, parentId, $6, price, path::uuid[]
+            from unnest($1::uuid[], $2::text[], $3::text[], $4::uuid[], $5::integer[], $7::text[])
+                as item(id, name, type, parentId, price, path)
+            on conflict (id) do update
             set name = excluded.name, parentid = excluded.parentid,
-            date = excluded.date, price = excluded.price
-            returning id
+            date = excluded.date, price = excluded.price, path = excluded.path, revision = excluded.revision
         """
-        uuid = None
         try:
-            uuid = await DB.fetchval(sql,item.name, item.type.value, item.parentId,request.updateDate,item.price, item.id)
+            await DB.execute(
+                sql,
+                ids,
+                [item.name for item in items],
+                [item.type.value for item in items],
+                parent_ids,
+                [item.price for item in items],
+                request.updateDate,
+                [_path_literal(path) for path in new_paths],
+            )
         except ForeignKeyViolationError as e:
             raise BadRequest('Родитель не существует') from e
+        if moved_ids:
+            # Потомок берёт новый путь у ближайшего к нему перемещённого предка
+            sql = """
+                with moved as (
+                    select id, path from shop_units
+                    where id = any($1::uuid[])
+                ),
+                rewritten as (
+                    select distinct on (descendant.id) descendant.id,
+                        moved.path || descendant.path[array_position(descendant.path, moved.id) + 1:] as path
+                    from moved
+                    join shop_units as descendant on descendant.path @> array[moved.id]
+                    where descendant.id <> all($2::uuid[])
+                    order by descendant.id, array_position(descendant.path, moved.id) desc
+                )
+                update shop_units
+                set path = rewritten.path
+                from rewritten
+                where shop_units.id = rewritten.id
+            """
+            await DB.execute(sql, moved_ids, ids)
+        # Обновление агрегатов и даты у всех старых и новых предков
         sql = """
-            insert into snapshot
-                select * from shop_units
-                where id = $1
+            update shop_units
+            set offers_sum = shop_units.offers_sum + delta.offers_sum,
+            offers_count = shop_units.offers_count + delta.offers_count,
+            date = $4, revision = nextval('shop_unit_revisions')
+            from unnest($1::uuid[], $2::bigint[], $3::integer[]) as delta(id, offers_sum, offers_count)
+            where shop_units.id = delta.id
         """
-        await DB.execute(sql, uuid)
-        unique_parent_ids.add(item.parentId)
-    st = list(unique_parent_ids)
-    while st:
-        cur = st.pop()
+        await DB.execute(
+            sql,
+            ancestor_ids,
+            [sum_deltas[ancestor_id] for ancestor_id in ancestor_ids],
+            [count_deltas[ancestor_id] for ancestor_id in ancestor_ids],
+            request.updateDate,
+        )
         sql = """
-            update shop_units
-            set date = $1
-            where id = $2
-            returning parentid
+            insert into snapshot(id, name, type, parentId, date, price, offers_sum, offers_count)
+                select id, name, type, parentId, date, price, offers_sum, offers_count from shop_units
+                where id = any($1::uuid[])
+        """
+        await DB.execute(sql, list(set(ids) | set(ancestor_ids)))
+        sql = """
+            insert into offer_updates(bucket, id, name, parentId, date, price)
+                select date_trunc('hour', date, 'UTC'), id, name, parentId, date, price from shop_units
+                where id = any($1::uuid[]) and type = $2 and date is not null
+            on conflict (bucket, id, date) do update
+            set name = excluded.name, parentId = excluded.parentId, price = excluded.price
         """
-        comming = await DB.fetchval(sql, request.updateDate, cur)
-        if comming:
-            st.append(comming)
+        await DB.execute(sql, ids, ShopUnitType.OFFER.value)
+    return ancestor_ids
 
 
-async def delete_shop_unit(unit_id: UUID) -> None:
+async def delete_shop_unit(unit_id: UUID) -> tuple[int, int]:
+    """Удаляет элемент вместе с поддеревом и его историей одним запросом под блокировкой дерева.
+
+    Сумма цен и число удалённых товаров сразу вычитаются из агрегатов предков
+    и возвращаются вызывающему.
+    """
     sql = """
-        select id from shop_units
-        where id = $1
+        with subtree as (
+            select id, type, price from shop_units
+            where path @> array[$1::uuid]
+        ),
+        ancestors(id) as (
+            select unnest(path[:cardinality(path) - 1]) from shop_units
+            where id = $1
+        ),
+        removed_offers as (
+            select coalesce(sum(price), 0) as offers_sum, count(price) as offers_count
+            from subtree
+            where type = $2
+        ),
+        removed_snapshots as (
+            delete from snapshot
+            where id in (select id from subtree)
+        ),
+        removed_updates as (
+            delete from offer_updates
+            where id in (select id from subtree)
+        ),
+        removed as (
+            delete from shop_units
+            where id in (select id from subtree)
+            returning id
+        ),
+        updated as (
+            update shop_units
+            set offers_sum = shop_units.offers_sum - removed_offers.offers_sum,
+            offers_count = shop_units.offers_count - removed_offers.offers_count,
+            revision = nextval('shop_unit_revisions')
+            from removed_offers
+            where shop_units.id in (select id from ancestors)
+            returning shop_units.id
+        )
+        select
+            array(select id from removed) as removed_ids,
+            array(select id from updated) as ancestor_ids,
+            offers_sum, offers_count
+        from removed_offers
     """
-    unit_id = await DB.fetchval(sql, unit_id)
-    if not unit_id:
+    result = await _with_subtree_locks(_delete_subtree, await _find_roots([unit_id]), sql, unit_id)
+    if not result['removed_ids']:
         raise NotFoundException('Категория/товар не найден')
+    await cache.invalidate(result['removed_ids'] + result['ancestor_ids'])
+    return result['offers_sum'], result['offers_count']
+
+async def _delete_subtree(sql: str, unit_id: UUID, root_ids: set[UUID]) -> Record:
+    async with DB.transaction():
+        if root_ids:
+            await _lock_subtrees(root_ids)
+        root_id = await DB.fetchval('select path[1] from shop_units where id = $1', unit_id)
+        if root_id is not None and root_id not in root_ids:
+            raise _SubtreesChanged({root_id})
+        return await DB.fetchrow(sql, unit_id, ShopUnitType.OFFER.value)
+
+async def fetch_subtree(unit_id: UUID) -> list[Record]:
+    # Всё поддерево одним поиском по индексу путей, уровни упорядочены от корня вглубь.
+    # Порядок колонок - serializers.TREE_COLUMNS, revision сериализатору не нужна
     sql = """
-        delete from shop_units
-        where id = $1
+        select id, name, type, parentId, date,
+            case when type = $2 then offers_sum / nullif(offers_count, 0) else price end as price,
+            revision
+        from shop_units
+        where path @> array[$1::uuid]
+        order by cardinality(path)
     """
-    await DB.execute(sql,unit_id)
+    records = await DB.fetch(sql, unit_id, ShopUnitType.CATEGORY.value)
+    if not records:
+        raise NotFoundException('Категория/товар не найден')
+    return records
 
-async def get_shop_unit(unit_id: UUID) -> ShopUnitOutput:
-    async def recursive_get(unit_id: UUID) -> (ShopUnitOutput, int, int):
-        sql = """
-            select id, name, type, parentId, date, price from shop_units
-            where id = $1
-        """
-        root = await DB.fetchrow(sql,unit_id)
-        root = format_record(root, ShopUnitOutput)
-        sql = """
-            select id from shop_units
-            where parentid = $1
-        """
-        children_uuids = await DB.fetch(sql, unit_id)
-        children = [await recursive_get(uuid['id']) for uuid in children_uuids]
-        price_sum = sum(map(lambda x: x[1], children))
-        price_num = sum(map(lambda x: x[2], children))
-        if root.type == ShopUnitType.CATEGORY:
-            if price_num:
-                root.price = price_sum // price_num
-            else:
-                root.price = None
-        else:
-            price_sum = root.price
-            price_num = 1
-        root.children = list(map(lambda x: x[0], children))
-        if not root.children:
-            root.children = None
-        return root, price_sum, price_num
+Check = Optional[Callable[[dict[str, str]], None]]
 
+async def get_shop_unit_json(unit_id: UUID, check: Check = None) -> tuple[dict[str, str], bytes]:
+    """Заголовки версии и тело /nodes/{id}. check - см. conditional.freshness_check"""
+    async def render() -> bytes:
+        if check is not None:
+            # Условный запрос без кэша: сначала дешёвое чтение версии, дерево - только если изменилось
+            version = await get_version(unit_id)
+            check(version_headers(version['date'], version['revision']))
+        await admit('nodes')
+        records = await fetch_subtree(unit_id)
+        # Версия корня из того же запроса, что и дерево
+        headers = version_headers(records[0]['date'], records[0]['revision'])
+        return pack(headers, await tree_offload.encode_tree(records))
+    headers, body = unpack(await cache.get_or_render(f'node:{unit_id}', [unit_id], render))
+    if check is not None:
+        check(headers)
+    return headers, body
+
+# Последнее обновление каждого товара за [$1, $2]: не больше 25 часовых корзин
+UPDATED_SQL = """
+   select distinct on (id) id, name, $3::text as type, parentId, date, price from offer_updates
+   where bucket between date_trunc('hour', $1::timestamptz, 'UTC') and date_trunc('hour', $2::timestamptz, 'UTC')
+   and $1 <= date and date <= $2
+   order by id, date desc
+"""
+
+async def get_updated_json(date: datetime) -> bytes:
+    result = await DB.fetch(UPDATED_SQL, date - timedelta(days=1), date, ShopUnitType.OFFER.value)
+    return encode_plain_list(result)
+
+def stream_updated(date: datetime) -> AsyncIterator[bytes]:
+    records = DB.iterate(UPDATED_SQL, date - timedelta(days=1), date, ShopUnitType.OFFER.value,
+                         prefetch=STREAM_CHUNK_SIZE)
+    return stream_json_array(records, STREAM_CHUNK_SIZE, encode_plain)
+
+
+async def get_version(unit_id: UUID) -> Record:
+    """Дата и версия элемента для ETag /nodes/{id}: одно чтение по первичному ключу"""
     sql = """
-        select id from shop_units
+        select date, revision from shop_units
         where id = $1
     """
-    root = await DB.fetchrow(sql, unit_id)
-    if not root:
+    record = await DB.fetchrow(sql, unit_id)
+    if record is None:
         raise NotFoundException('Категория/товар не найден')
-    result = await recursive_get(unit_id)
-    return result[0]
+    return record
 
-async def get_updated(date: datetime) -> list[ShopUnitOutputPlain]:
+async def get_statistic_version(unit_id: UUID) -> Record:
+    """Как get_version, плюс состояние партиций истории: прореживание и удаление старых
+    партиций меняют статистику, не трогая версии элементов"""
     sql = """
-       select id, name, type, parentId, date, price from shop_units
-       where $1 <= date and date <= $2 and type = $3
+        select date, revision,
+            (select count(*) filter (where compacted) from snapshot_partitions) as compacted,
+            (select min(starts_at) from snapshot_partitions) as oldest
+        from shop_units
+        where id = $1
     """
-    result = await DB.fetch(sql,date - timedelta(days=1), date, ShopUnitType.OFFER.value)
-    return format_records(result, ShopUnitOutputPlain)
+    record = await DB.fetchrow(sql, unit_id)
+    if record is None:
+        raise NotFoundException('Категория/товар не найден')
+    return record
 
+def statistic_headers(version: Record) -> dict[str, str]:
+    oldest = int(version['oldest'].timestamp()) if version['oldest'] else 0
+    return version_headers(version['date'], version['revision'], version['compacted'], oldest)
 
-async def get_snapshots(uuid: UUID, date_start: datetime, date_end: datetime) -> list[ShopUnitOutputPlain]:
-    async def calculate_category_price(uuid: UUID, date_end: datetime) -> int:
-        sql = """
-            select id, type, price, date from snapshot
-            where date <= $1 and id = $2
-            order by date desc 
-        """
-        root = await DB.fetchrow(sql, date_end, uuid)
-        if root['type'] == ShopUnitType.OFFER:
-            return root.price
-        sql = """
-            select id,date from snapshot
-            where parentid = $1 and date <= $2
-        """
-        children = await DB.fetch(sql, uuid, root['date'])
-        coroutines = [
-            calculate_category_price(item['id'], item['date'])
-            for item in children
-        ]
-        return sum(list(await gather(*coroutines)))
+async def stream_snapshots(uuid: UUID, date_start: datetime, date_end: datetime,
+                           check: Check = None) -> tuple[dict[str, str], AsyncIterator[bytes]]:
+    # Версия читается до начала ответа, чтобы успеть вернуть 404 или 304.
+    # Поток читается позже, поэтому тело может быть новее ETag, но не старше
+    headers = statistic_headers(await get_statistic_version(uuid))
+    if check is not None:
+        check(headers)
+    await admit('statistic')
+    items = history.iter_statistic(uuid, date_start, date_end, STREAM_CHUNK_SIZE)
+    return headers, stream_json_array(items, STREAM_CHUNK_SIZE, encode_plain)
 
-
-    sql = """
-        select id, name, type, parentId, date, price from snapshot
-        where $1 <= date and date < $2
-    """
-    result = format_records(await DB.fetch(sql, date_start, date_end), ShopUnitOutputPlain)
-    for item in result:
-        if item.type.value == ShopUnitType.CATEGORY.value:
-            item.price = await calculate_category_price(item.id, item.date)
-    return result
\ No newline at end of file
+async def get_snapshots_json(uuid: UUID, date_start: datetime, date_end: datetime,
+                             check: Check = None) -> tuple[dict[str, str], bytes]:
+    async def render() -> bytes:
+        if check is not None:
+            check(statistic_headers(await get_statistic_version(uuid)))
+        await admit('statistic')
+        # Версия и история из одного снимка базы
+        async with DB.transaction(isolation='repeatable_read', readonly=True):
+            headers = statistic_headers(await get_statistic_version(uuid))
+            statistic = await history.get_statistic(uuid, date_start, date_end)
+        return pack(headers, encode_plain_list(statistic))
+    key = f'statistic:{uuid}:{date_start.isoformat()}:{date_end.isoformat()}'
+    headers, body = unpack(await cache.get_or_render(key, [uuid, STATISTIC_TAG], render))
+    if check is not None:
+        check(headers)
+    return headers, body
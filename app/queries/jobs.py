@@ -0,0 +1,33 @@
+from typing import Optional
+from uuid import UUID
+
+from app.db.db import DB
+from app.exceptions import NotFoundException
+from app.models import ImportJob, ImportJobStatus
+
+
+async def create_job(job_id: UUID, total: Optional[int]) -> None:
+    sql = """
+        insert into import_jobs(id, total)
+        values ($1, $2)
+    """
+    await DB.execute(sql, job_id, total)
+
+async def update_job(job_id: UUID, status: ImportJobStatus, processed: Optional[int] = None,
+                     error: Optional[str] = None) -> None:
+    sql = """
+        update import_jobs
+        set status = $2, processed = coalesce($3, processed), error = $4, updated_at = now()
+        where id = $1
+    """
+    await DB.execute(sql, job_id, status.value, processed, error)
+
+async def get_job(job_id: UUID) -> ImportJob:
+    sql = """
+        select id, status, processed, total, error from import_jobs
+        where id = $1
+    """
+    record = await DB.fetchrow(sql, job_id)
+    if record is None:
+        raise NotFoundException('Импорт не найден')
+    return ImportJob(**record)
@@ -1,18 +1,31 @@
 from datetime import timedelta,datetime
 from uuid import UUID
 
-from fastapi import APIRouter, HTTPException, status, Path, Query
+import os
+
+from fastapi import APIRouter, HTTPException, status, Path, Query, Request
 from fastapi.param_functions import Depends
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
 import app.queries.items as items_queries
+import app.queries.jobs as jobs_queries
+from app.admission import admission_scope, admit
+from app.conditional import freshness_check
+from app.db.db import db_session, SessionRoute
 from app.exceptions import NotFoundException, BadRequest, ForbiddenException
 from app.models import SuccessfullResponse, ShopUnitImportRequest, ShopUnitOutput, ShopUnitOutputPlain
-from app.models import NotFoundError, ValidationError
-from app.utils import format_record
+from app.models import NotFoundError, ValidationError, ImportJob, ImportJobStatus
+from app.jobs import import_queue, request_runner, ndjson_runner, spool
+from app.settings import STREAM_RESPONSES
 
-basic_router = APIRouter(tags=["Базовые задачи"])
-additional_router = APIRouter(tags=['Дополнительные задачи'])
+# Каждый обработчик работает с базой через одно закреплённое соединение, оно
+# возвращается в пул, когда ответ готов (потоковый - после отправки).
+# Места в лимитах тяжёлых обработчиков (admit) держатся до отправки ответа
+basic_router = APIRouter(tags=["Базовые задачи"], route_class=SessionRoute,
+                         dependencies=[Depends(db_session), Depends(admission_scope)])
+additional_router = APIRouter(tags=['Дополнительные задачи'], route_class=SessionRoute,
+                              dependencies=[Depends(db_session), Depends(admission_scope)])
 
 # TODO: пошаманить с responses
 # TODO: response_model_exclude
@@ -73,9 +86,15 @@ async def delete_units(id: UUID = Path(..., description='Идентификат
 @basic_router.get('/nodes/{id}',
                   response_model=ShopUnitOutput,
                   responses={
+                      304: {
+                          "description": "Элемент не изменился с версии из If-None-Match/If-Modified-Since"
+                      },
                       400: {
                           "description": "Невалидная схема документа или входные данные не верны",
                           "model": ValidationError
+                      },
+                      503: {
+                          "description": "Сервер перегружен, повторить запрос через Retry-After секунд"
                       }
                   },
                   description="""
@@ -84,9 +103,9 @@ async def delete_units(id: UUID = Path(..., description='Идентификат
                   - для пустой категории поле children равно пустому массиву, а для товара равно null
                   - цена категории - это средняя цена всех её товаров, включая товары дочерних категорий. Если категория не содержит товаров цена равна null. При обновлении цены товара, средняя цена категории, которая содержит этот товар, тоже обновляется.                    """
                   )
-async def get_units(id: UUID = Path(..., description='Идентификатор элемента')):
-    result = await items_queries.get_shop_unit(id)
-    return result
+async def get_units(request: Request, id: UUID = Path(..., description='Идентификатор элемента')):
+    headers, result = await items_queries.get_shop_unit_json(id, freshness_check(request))
+    return Response(result, media_type='application/json', headers=headers)
 
 @additional_router.get('/sales',
                       response_model=list[ShopUnitOutputPlain],
@@ -94,6 +113,9 @@ async def get_units(id: UUID = Path(..., description='Идентификатор
                            400: {
                                "description": "Невалидная схема документа или входные данные не верны",
                                "model": ValidationError
+                           },
+                           503: {
+                               "description": "Сервер перегружен, повторить запрос через Retry-After секунд"
                            }
                        },
                       description="""
@@ -103,12 +125,18 @@ async def get_units(id: UUID = Path(..., description='Идентификатор
                       - можно получить статистику за всё время. """
                       )
 async def get_sales(date: datetime = Query(..., description='Дата и время запроса. Дата должна обрабатываться согласно ISO 8601 (такой придерживается OpenAPI). Если дата не удовлетворяет данному формату, необходимо отвечать 400')):
-    result = await items_queries.get_updated(date)
-    return result
+    await admit('sales')
+    if STREAM_RESPONSES:
+        return StreamingResponse(items_queries.stream_updated(date), media_type='application/json')
+    result = await items_queries.get_updated_json(date)
+    return Response(result, media_type='application/json')
 
 @additional_router.get('/node/{id}/statistic',
                        response_model=list[ShopUnitOutputPlain],
                        responses={
+                           304: {
+                               "description": "Статистика не изменилась с версии из If-None-Match/If-Modified-Since"
+                           },
                            400: {
                                "description": "Невалидная схема документа или входные данные не верны",
                                "model": ValidationError
@@ -116,6 +144,9 @@ async def get_sales(date: datetime = Query(..., description='Дата и вре
                            404: {
                                "description": "Категория/товар не найден",
                                "model": NotFoundError
+                           },
+                           503: {
+                               "description": "Сервер перегружен, повторить запрос через Retry-After секунд"
                            }
                        },
                        description="""
@@ -125,8 +156,71 @@ async def get_sales(date: datetime = Query(..., description='Дата и вре
                        - можно получить статистику за всё время.
                         """
                        )
-async def get_statistic(id: UUID = Path(..., description='UUID товара/категории для которой будет отображаться статистика'),
+async def get_statistic(request: Request,
+                        id: UUID = Path(..., description='UUID товара/категории для которой будет отображаться статистика'),
                         dateStart: datetime = Query(..., description='Дата и время начала интервала, для которого считается статистика. Дата должна обрабатываться согласно ISO 8601 (такой придерживается OpenAPI). Если дата не удовлетворяет данному формату, необходимо отвечать 400.'),
                         dateEnd: datetime = Query(..., description='Дата и время конца интервала, для которого считается статистика. Дата должна обрабатываться согласно ISO 8601 (такой придерживается OpenAPI). Если дата не удовлетворяет данному формату, необходимо отвечать 400.')):
-    result = await items_queries.get_snapshots(id,dateStart,dateEnd)
-    return result
+    check = freshness_check(request)
+    if STREAM_RESPONSES:
+        headers, result = await items_queries.stream_snapshots(id,dateStart,dateEnd,check)
+        return StreamingResponse(result, media_type='application/json', headers=headers)
+    headers, result = await items_queries.get_snapshots_json(id,dateStart,dateEnd,check)
+    return Response(result, media_type='application/json', headers=headers)
+
+@additional_router.post('/imports/async',
+                        status_code=status.HTTP_202_ACCEPTED,
+                        response_model=ImportJob,
+                        responses={
+                            503: {
+                                "description": "Очередь импортов заполнена"
+                            }
+                        },
+                        description="""
+                        Ставит импорт в фоновую очередь и сразу возвращает идентификатор задачи. Правила те же, что у /imports, проверка данных выполняется при обработке. Состояние задачи - GET /imports/{id}.
+                        """
+                        )
+async def import_units_async(request: ShopUnitImportRequest):
+    job_id = await import_queue.submit(request_runner(request), total=len(request.items))
+    return ImportJob(id=job_id, status=ImportJobStatus.QUEUED, total=len(request.items))
+
+@additional_router.post('/imports/ndjson',
+                        status_code=status.HTTP_202_ACCEPTED,
+                        response_model=ImportJob,
+                        responses={
+                            503: {
+                                "description": "Очередь импортов заполнена"
+                            }
+                        },
+                        description="""
+                        Фоновый импорт потока NDJSON: по одному элементу ShopUnitImport на строку. Тело запроса пишется во временный файл и импортируется пачками, каждая в своей транзакции.
+
+                        - родитель должен встретиться раньше потомка или в той же пачке
+                        - при ошибке уже импортированные пачки остаются, processed показывает их размер
+                        """
+                        )
+async def import_units_ndjson(request: Request,
+                              updateDate: datetime = Query(..., description='Время обновления всех элементов потока')):
+    # Отказываем до чтения тела, если очередь уже заполнена
+    import_queue.check_capacity()
+    path = await spool(request.stream())
+    try:
+        job_id = await import_queue.submit(ndjson_runner(path, updateDate))
+    except BaseException:
+        os.remove(path)
+        raise
+    return ImportJob(id=job_id, status=ImportJobStatus.QUEUED)
+
+@additional_router.get('/imports/{job_id}',
+                       response_model=ImportJob,
+                       responses={
+                           404: {
+                               "description": "Импорт не найден",
+                               "model": NotFoundError
+                           }
+                       },
+                       description="""
+                       Состояние фонового импорта: queued, running, done или failed, число уже импортированных элементов и причина ошибки.
+                       """
+                       )
+async def get_import(job_id: UUID = Path(..., description='Идентификатор фонового импорта')):
+    return await jobs_queries.get_job(job_id)
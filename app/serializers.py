@@ -0,0 +1,99 @@
+"""Сериализация записей asyncpg сразу в JSON, без моделей pydantic.
+
+Результат побайтно совпадает с тем, что отдаёт FastAPI для response_model
+ShopUnitOutput и ShopUnitOutputPlain.
+"""
+import json
+from typing import Any, Iterable, Mapping, Optional
+
+from app.utils import format_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Node):
+        return obj.as_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+class Node:
+    """Элемент дерева /nodes/{id} с уже отформатированными полями"""
+    __slots__ = ('id', 'name', 'parentId', 'type', 'date', 'price', 'children')
+
+    def __init__(self, raw_record: Mapping) -> None:
+        self.id = str(raw_record['id'])
+        self.name = raw_record['name']
+        self.parentId = str(raw_record['parentid']) if raw_record['parentid'] else None
+        self.type = raw_record['type']
+        self.date = format_date(raw_record['date'])
+        self.price = raw_record['price']
+        self.children = []
+
+    def as_dict(self) -> dict:
+        # Дочерние Node сериализуются тем же default-хуком
+        return {
+            'id': self.id,
+            'name': self.name,
+            'parentId': self.parentId,
+            'type': self.type,
+            'date': self.date,
+            'price': self.price,
+            'children': self.children or None,
+        }
+
+
+def build_nodes(raw_records: Iterable[Mapping]) -> Optional[Node]:
+    # Записи идут от корня вглубь: родитель всегда встречается раньше потомков
+    nodes = {}
+    root = None
+    for raw_record in raw_records:
+        node = Node(raw_record)
+        if root is None:
+            root = node
+        else:
+            parent = nodes.get(node.parentId)
+            if parent is not None:
+                parent.children.append(node)
+        nodes[node.id] = node
+    return root
+
+
+def encode_tree(raw_records: Iterable[Mapping]) -> bytes:
+    return dumps(build_nodes(raw_records))
+
+
+# Порядок колонок fetch_subtree: в пул процессов записи уходят кортежами
+TREE_COLUMNS = ('id', 'name', 'type', 'parentid', 'date', 'price')
+
+
+def encode_tree_rows(rows: Iterable[tuple]) -> bytes:
+    return encode_tree(dict(zip(TREE_COLUMNS, row)) for row in rows)
+
+
+def plain_row(raw_record: Mapping) -> dict:
+    return {
+        'id': str(raw_record['id']),
+        'name': raw_record['name'],
+        'date': raw_record['date'].isoformat(),
+        'parentId': str(raw_record['parentid']) if raw_record['parentid'] else None,
+        'price': raw_record['price'],
+        'type': raw_record['type'],
+    }
+
+
+def encode_plain(raw_record: Mapping) -> bytes:
+    return dumps(plain_row(raw_record))
+
+
+def encode_plain_list(raw_records: Iterable[Mapping]) -> bytes:
+    return dumps([plain_row(raw_record) for raw_record in raw_records])
@@ -2,4 +2,75 @@ import os
 
 DATABASE_URL: str = os.getenv("DATABASE_URL")
 SERVER_PORT: str = os.getenv("SERVER_PORT")
+# Число процессов uvicorn, 0 - по числу ядер. При запуске uvicorn напрямую с --workers
+# нужно передать то же число: от него зависит размер пула каждого процесса
+WORKERS: int = int(os.getenv("WORKERS", 0)) or os.cpu_count() or 1
+# Сколько секунд при остановке ждать незавершённые запросы и фоновые импорты
+SHUTDOWN_TIMEOUT: float = float(os.getenv("SHUTDOWN_TIMEOUT", 30))
+# Применять app/db/migrations при старте приложения
+MIGRATE_ON_STARTUP: bool = os.getenv("MIGRATE_ON_STARTUP", "true").lower() == "true"
 
+# Соединений с базой на все процессы вместе: у Postgres по умолчанию max_connections = 100.
+# Пул процесса - не больше DB_POOL_MAX_SIZE и не больше DB_MAX_CONNECTIONS // WORKERS
+DB_MAX_CONNECTIONS: int = int(os.getenv("DB_MAX_CONNECTIONS", 80))
+# Пул соединений asyncpg. Таймауты в секундах, 0 - без ограничения
+DB_POOL_MAX_SIZE: int = max(min(int(os.getenv("DB_POOL_MAX_SIZE", 20)), DB_MAX_CONNECTIONS // WORKERS), 1)
+DB_POOL_MIN_SIZE: int = min(int(os.getenv("DB_POOL_MIN_SIZE", 5)), DB_POOL_MAX_SIZE)
+DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+DB_COMMAND_TIMEOUT: float = float(os.getenv("DB_COMMAND_TIMEOUT", 0))
+DB_ACQUIRE_TIMEOUT: float = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DB_CONNECT_TIMEOUT: float = float(os.getenv("DB_CONNECT_TIMEOUT", 10))
+# Попытки подключиться к базе при старте, пауза между ними растёт вдвое
+DB_CONNECT_RETRIES: int = int(os.getenv("DB_CONNECT_RETRIES", 5))
+DB_CONNECT_BACKOFF: float = float(os.getenv("DB_CONNECT_BACKOFF", 0.5))
+# Через сколько секунд простоя соединение закрывается
+DB_MAX_INACTIVE_LIFETIME: float = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+# Запросы дольше порога пишутся в лог, 0 - не писать
+SLOW_QUERY_MS: float = float(os.getenv("SLOW_QUERY_MS", 500))
+
+# Хранение истории: 0 - хранить всё / не прореживать
+SNAPSHOT_RETENTION_DAYS: int = int(os.getenv("SNAPSHOT_RETENTION_DAYS", 0))
+SNAPSHOT_COMPACT_AFTER_DAYS: int = int(os.getenv("SNAPSHOT_COMPACT_AFTER_DAYS", 0))
+SNAPSHOT_MAINTENANCE_INTERVAL: int = int(os.getenv("SNAPSHOT_MAINTENANCE_INTERVAL", 3600))
+
+# memory - LRU в каждом воркере, redis - общий кэш, none - без кэша.
+# memory при WORKERS > 1 требует CACHE_REDIS_URL для рассылки инвалидаций, без него
+# кэш отключается (см. app.cache.create_cache). В docker-compose для этого есть сервис redis
+CACHE_BACKEND: str = os.getenv("CACHE_BACKEND", "memory")
+# Для memory используется только для рассылки инвалидаций между воркерами
+CACHE_REDIS_URL: str = os.getenv("CACHE_REDIS_URL")
+CACHE_MAX_ENTRIES: int = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+CACHE_MAX_BYTES: int = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_TTL: int = int(os.getenv("CACHE_TTL", 3600))
+
+# Отдавать /sales и /node/{id}/statistic потоком, читая базу курсором.
+# В этом режиме ответы статистики не кэшируются.
+STREAM_RESPONSES: bool = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_CHUNK_SIZE: int = int(os.getenv("STREAM_CHUNK_SIZE", 500))
+
+# Дерево /nodes/{id} от TREE_OFFLOAD_THRESHOLD элементов собирается и сериализуется
+# в пуле из TREE_OFFLOAD_WORKERS процессов, 0 - всегда в цикле событий
+TREE_OFFLOAD_THRESHOLD: int = int(os.getenv("TREE_OFFLOAD_THRESHOLD", 5000))
+TREE_OFFLOAD_WORKERS: int = int(os.getenv("TREE_OFFLOAD_WORKERS", 2))
+
+# Параллельных запросов к /nodes/{id}, /node/{id}/statistic и /sales на воркер, 0 - без ограничения.
+# Сверх лимита запрос ждёт не дольше ADMISSION_TIMEOUT секунд, а если ждущих уже
+# ADMISSION_QUEUE_SIZE - сразу получает 503 с Retry-After: ADMISSION_RETRY_AFTER
+NODES_CONCURRENCY: int = int(os.getenv("NODES_CONCURRENCY", 8))
+STATISTIC_CONCURRENCY: int = int(os.getenv("STATISTIC_CONCURRENCY", 8))
+SALES_CONCURRENCY: int = int(os.getenv("SALES_CONCURRENCY", 4))
+# Соединения пула, которые не достаются этим трём обработчикам: /imports, /delete,
+# фоновые импорты и обслуживание истории. Вместе тяжёлые запросы занимают не больше
+# DB_POOL_MAX_SIZE - DB_POOL_RESERVED соединений (но хотя бы одно)
+DB_POOL_RESERVED: int = int(os.getenv("DB_POOL_RESERVED", 3))
+HEAVY_CONCURRENCY: int = max(DB_POOL_MAX_SIZE - DB_POOL_RESERVED, 1)
+ADMISSION_QUEUE_SIZE: int = int(os.getenv("ADMISSION_QUEUE_SIZE", 50))
+ADMISSION_TIMEOUT: float = float(os.getenv("ADMISSION_TIMEOUT", 2))
+ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", 1))
+
+# Фоновые импорты: число воркеров очереди, её размер, элементов NDJSON в одной транзакции
+IMPORT_WORKERS: int = int(os.getenv("IMPORT_WORKERS", 1))
+IMPORT_QUEUE_SIZE: int = int(os.getenv("IMPORT_QUEUE_SIZE", 100))
+IMPORT_CHUNK_SIZE: int = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+# Куда складывается тело NDJSON-импорта до обработки, по умолчанию временный каталог
+IMPORT_SPOOL_DIR: str = os.getenv("IMPORT_SPOOL_DIR")
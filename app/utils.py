@@ -1,22 +1,22 @@
 from datetime import datetime
-from typing import Type
+from typing import Any, AsyncIterator, Callable
 from asyncpg import Record
-from app.models import BaseModel, ShopUnitOutput
 
-def format_records(raw_records: list[Record], model: Type[BaseModel]) -> list[BaseModel]:
-    if not raw_records:
-        return []
-    return list(map(lambda x: model(**x), raw_records))
-
-def format_record(raw_record: Record, model: Type[BaseModel]) -> BaseModel:
-    if not raw_record:
-        return None
-    result = model(**raw_record)
-    if model == ShopUnitOutput and raw_record['parentid']:
-        result.parentId = raw_record['parentid']
-    if model == ShopUnitOutput:
-        result.date = format_date(result.date)
-    return result
+async def stream_json_array(items: AsyncIterator[Any], chunk_size: int,
+                            encode: Callable[[Any], bytes]) -> AsyncIterator[bytes]:
+    # Те же байты, что encode для всего списка, частями по chunk_size элементов
+    separator = b''
+    chunk = []
+    yield b'['
+    async for item in items:
+        chunk.append(encode(item))
+        if len(chunk) >= chunk_size:
+            yield separator + b','.join(chunk)
+            separator = b','
+            chunk = []
+    if chunk:
+        yield separator + b','.join(chunk)
+    yield b']'
 
 def format_date(date:datetime) -> str:
     # return date.replace(microsecond=0).isoformat() + 'Z'
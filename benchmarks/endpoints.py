@@ -0,0 +1,251 @@
+"""Нагрузочный прогон всех пяти обработчиков в одном процессе через ASGI-клиент.
+
+Строит синтетический каталог заданной глубины и ширины, накапливает историю цен
+и замеряет /imports, /nodes/{id}, /sales, /node/{id}/statistic и /delete/{id}.
+На каждый обработчик выводит p50/p99, пропускную способность и число запросов
+к базе в виде JSON, чтобы результаты можно было сравнивать между коммитами.
+
+Отдельная фаза "/nodes/{id} + root" замеряет мелкие поддеревья, пока параллельно
+запрашивается корень каталога: так видно, насколько большое дерево задерживает
+остальные запросы (с --offload-threshold 0 и без). Без --no-cache корень
+строится только один раз.
+
+Лимиты параллельных запросов (NODES_/STATISTIC_/SALES_CONCURRENCY) задаются
+--admission-limit, по умолчанию сняты; общий лимит heavy всегда остаётся меньше
+пула на DB_POOL_RESERVED. Отказы 503 считаются отдельно (rejected) и в задержки
+не входят.
+
+Все данные в базе --database-url удаляются!
+
+    python -m benchmarks.endpoints --database-url postgresql://postgres@localhost/bench \\
+        --depth 4 --fanout 4 --history 20 --requests 200 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+
+def make_catalogue(depth: int, fanout: int) -> list[dict]:
+    """Полное дерево: категории на уровнях 0..depth-1, товары на уровне depth. Родители идут раньше детей."""
+    root = {'id': str(uuid.uuid4()), 'name': 'Категория 0', 'parentId': None, 'type': 'CATEGORY'}
+    items = [root]
+    level = [root]
+    for current_depth in range(1, depth + 1):
+        is_offer = current_depth == depth
+        next_level = []
+        for parent in level:
+            for _ in range(fanout):
+                item = {
+                    'id': str(uuid.uuid4()),
+                    'name': f'{"Товар" if is_offer else "Категория"} {len(items)}',
+                    'parentId': parent['id'],
+                    'type': 'OFFER' if is_offer else 'CATEGORY',
+                }
+                if is_offer:
+                    item['price'] = random.randint(1, 100000)
+                items.append(item)
+                next_level.append(item)
+        level = next_level
+    return items
+
+
+def percentile(latencies: list[float], share: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[max(math.ceil(share * len(ordered)) - 1, 0)]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.rejected = 0
+        self.queries: Optional[int] = 0
+        self.elapsed = 0.0
+
+    def report(self) -> dict:
+        count = len(self.latencies)
+        if not count:
+            return {'requests': 0, 'rejected': self.rejected}
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'p50_ms': round(percentile(self.latencies, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 2),
+            'mean_ms': round(sum(self.latencies) / count * 1000, 2),
+            'rps': round(count / self.elapsed, 1) if self.elapsed else None,
+            'queries_per_request': round(self.queries / count, 2) if self.queries is not None else None,
+        }
+
+
+async def run_phase(client, stats: Stats, requests: list[tuple], concurrency: int, count_queries: bool = True) -> None:
+    """Выполняет requests (method, url, kwargs) в concurrency параллельных потоков.
+
+    Для фаз, идущих одновременно, count_queries=False: счётчик запросов к базе общий.
+    """
+    from app.db.db import DB
+
+    pending = iter(requests)
+
+    async def worker() -> None:
+        for method, url, kwargs in pending:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            # Потоковые ответы учитываются целиком
+            await response.aread()
+            if response.status_code == 503:
+                # Быстрые отказы лимитов исказили бы задержки обработчика
+                stats.rejected += 1
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                stats.errors += 1
+
+    queries = DB.queries
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    stats.elapsed += time.perf_counter() - started
+    if count_queries:
+        stats.queries += DB.queries - queries
+    else:
+        stats.queries = None
+
+
+def iso(date: datetime) -> str:
+    return date.isoformat().replace('+00:00', 'Z')
+
+
+async def benchmark(args) -> dict:
+    import httpx
+    from app.api import app
+    from app.db.db import DB
+    from app.settings import TREE_OFFLOAD_THRESHOLD, TREE_OFFLOAD_WORKERS
+    from app.settings import NODES_CONCURRENCY, STATISTIC_CONCURRENCY, SALES_CONCURRENCY, HEAVY_CONCURRENCY
+
+    await app.router.startup()
+    try:
+        await DB.execute('truncate shop_units cascade')
+        await DB.execute('truncate snapshot')
+        await DB.execute('truncate offer_updates')
+        stats = {endpoint: Stats() for endpoint in ('/imports', '/nodes/{id}', '/nodes/{id} + root', '/nodes/{root}',
+                                                    '/sales', '/node/{id}/statistic', '/delete/{id}')}
+        async with httpx.AsyncClient(app=app, base_url='http://benchmark', timeout=None) as client:
+            items = make_catalogue(args.depth, args.fanout)
+            categories = [item['id'] for item in items if item['type'] == 'CATEGORY']
+            offers = [item for item in items if item['type'] == 'OFFER']
+            date = datetime(2022, 2, 1, tzinfo=timezone.utc)
+
+            # Импорты идут по одному: updateDate должен возрастать
+            imports = []
+            for start in range(0, len(items), args.batch):
+                imports.append(('POST', '/imports', {'json': {'items': items[start:start + args.batch], 'updateDate': iso(date)}}))
+                date += timedelta(minutes=1)
+            for _ in range(args.history):
+                date += timedelta(hours=1)
+                changed = [
+                    dict(offer, price=random.randint(1, 100000))
+                    for offer in random.sample(offers, min(args.batch, len(offers)))
+                ]
+                imports.append(('POST', '/imports', {'json': {'items': changed, 'updateDate': iso(date)}}))
+            await run_phase(client, stats['/imports'], imports, 1)
+
+            unit_ids = categories + [offer['id'] for offer in offers]
+            await run_phase(client, stats['/nodes/{id}'], [
+                ('GET', f'/nodes/{random.choice(categories)}', {}) for _ in range(args.requests)
+            ], args.concurrency)
+            # Категории последнего уровня, в каждой только fanout товаров (порядок обхода - по уровням)
+            small = categories[-args.fanout ** (args.depth - 1):]
+            await asyncio.gather(
+                run_phase(client, stats['/nodes/{id} + root'], [
+                    ('GET', f'/nodes/{random.choice(small)}', {}) for _ in range(args.requests)
+                ], args.concurrency, count_queries=False),
+                run_phase(client, stats['/nodes/{root}'], [
+                    ('GET', f'/nodes/{items[0]["id"]}', {}) for _ in range(max(args.requests // 20, 1))
+                ], 1, count_queries=False),
+            )
+            await run_phase(client, stats['/sales'], [
+                ('GET', '/sales', {'params': {'date': iso(date - timedelta(hours=random.randint(0, args.history)))}})
+                for _ in range(args.requests)
+            ], args.concurrency)
+            period = {'dateStart': '2022-01-01T00:00:00Z', 'dateEnd': iso(date + timedelta(days=1))}
+            await run_phase(client, stats['/node/{id}/statistic'], [
+                ('GET', f'/node/{random.choice(unit_ids)}/statistic', {'params': period}) for _ in range(args.requests)
+            ], args.concurrency)
+            victims = random.sample(offers, min(args.requests, len(offers)))
+            await run_phase(client, stats['/delete/{id}'], [
+                ('DELETE', f'/delete/{offer["id"]}', {}) for offer in victims
+            ], args.concurrency)
+    finally:
+        await app.router.shutdown()
+
+    return {
+        'config': {
+            'depth': args.depth,
+            'fanout': args.fanout,
+            'history': args.history,
+            'batch': args.batch,
+            'units': len(items),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'cache': os.environ.get('CACHE_BACKEND', 'memory'),
+            'offload_threshold': TREE_OFFLOAD_THRESHOLD,
+            'offload_workers': TREE_OFFLOAD_WORKERS,
+            'admission': {'nodes': NODES_CONCURRENCY, 'statistic': STATISTIC_CONCURRENCY, 'sales': SALES_CONCURRENCY,
+                          'heavy': HEAVY_CONCURRENCY},
+        },
+        'endpoints': {endpoint: endpoint_stats.report() for endpoint, endpoint_stats in stats.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('BENCHMARK_DATABASE_URL'),
+                        help='отдельная база для прогона, по умолчанию BENCHMARK_DATABASE_URL')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--history', type=int, default=20, help='число импортов с изменением цен')
+    parser.add_argument('--batch', type=int, default=100, help='элементов в одном импорте')
+    parser.add_argument('--requests', type=int, default=200, help='запросов к каждому обработчику чтения и удаления')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--no-cache', action='store_true', help='замерять без кэша ответов')
+    parser.add_argument('--offload-threshold', type=int,
+                        help='TREE_OFFLOAD_THRESHOLD: с какого размера дерево строится в пуле процессов, 0 - не выносить')
+    parser.add_argument('--offload-workers', type=int, help='TREE_OFFLOAD_WORKERS: процессов в пуле')
+    parser.add_argument('--admission-limit', type=int, default=0,
+                        help='NODES_/STATISTIC_/SALES_CONCURRENCY для всех трёх обработчиков, 0 - без лимита')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='файл для JSON, по умолчанию stdout')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('нужен --database-url или BENCHMARK_DATABASE_URL')
+
+    # Настройки приложения читаются при импорте app
+    os.environ['DATABASE_URL'] = args.database_url
+    # Приложение работает в этом процессе: пул и кэш рассчитываются на один воркер
+    os.environ['WORKERS'] = '1'
+    if args.no_cache:
+        os.environ['CACHE_BACKEND'] = 'none'
+    if args.offload_threshold is not None:
+        os.environ['TREE_OFFLOAD_THRESHOLD'] = str(args.offload_threshold)
+    if args.offload_workers is not None:
+        os.environ['TREE_OFFLOAD_WORKERS'] = str(args.offload_workers)
+    for setting in ('NODES_CONCURRENCY', 'STATISTIC_CONCURRENCY', 'SALES_CONCURRENCY'):
+        os.environ[setting] = str(args.admission_limit)
+    random.seed(args.seed)
+    result = json.dumps(asyncio.run(benchmark(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(result + '\n')
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
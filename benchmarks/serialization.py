@@ -0,0 +1,111 @@
+"""Сравнение сериализации дерева /nodes/{id}: pydantic + response_model против app.serializers.
+
+    python -m benchmarks.serialization --nodes 10000 --fanout 10 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.models import ShopUnitOutput, ShopUnitType
+from app.serializers import encode_tree
+from app.utils import format_date
+
+
+def make_records(nodes: int, fanout: int) -> list[dict]:
+    """Поддерево в том виде, в каком его возвращает fetch_subtree: от корня вглубь.
+
+    Узел i - ребёнок узла (i - 1) // fanout, узлы с детьми - категории.
+    """
+    date = datetime(2022, 2, 1, tzinfo=timezone.utc)
+    ids = [uuid.uuid4() for _ in range(nodes)]
+    records = []
+    for index in range(nodes):
+        is_category = index * fanout + 1 < nodes
+        records.append({
+            'id': ids[index],
+            'name': f'Элемент {index}',
+            'type': (ShopUnitType.CATEGORY if is_category else ShopUnitType.OFFER).value,
+            'parentid': ids[(index - 1) // fanout] if index else None,
+            'date': date + timedelta(minutes=index),
+            'price': index * 10,
+        })
+    return records
+
+
+def format_record(record: dict) -> ShopUnitOutput:
+    result = ShopUnitOutput(**record)
+    # Postgres возвращает имя колонки в нижнем регистре
+    if record['parentid']:
+        result.parentId = record['parentid']
+    result.date = format_date(result.date)
+    return result
+
+
+def build_tree(records: list[dict]) -> ShopUnitOutput:
+    # Прежняя сборка дерева из моделей: родитель всегда встречается раньше потомков
+    nodes = {}
+    order = []
+    for record in records:
+        node = format_record(record)
+        node.children = []
+        parent = nodes.get(record['parentid'])
+        if parent is not None and order:
+            parent.children.append(node)
+        nodes[node.id] = node
+        order.append(node)
+    for node in order:
+        if not node.children:
+            node.children = None
+    return order[0]
+
+
+async def pydantic_path(records: list[dict], field) -> bytes:
+    # Путь до app.serializers: модели на каждый узел и повторная проверка через response_model
+    content = await serialize_response(field=field, response_content=build_tree(records))
+    return JSONResponse(content).body
+
+
+def measure(repeat: int, func) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.nodes, args.fanout)
+    field = create_response_field(name='response', type_=ShopUnitOutput)
+    loop = asyncio.new_event_loop()
+    expected = loop.run_until_complete(pydantic_path(records, field))
+    if encode_tree(records) != expected:
+        sys.exit('app.serializers и pydantic дали разный JSON')
+
+    pydantic_time = measure(args.repeat, lambda: loop.run_until_complete(pydantic_path(records, field)))
+    fast_time = measure(args.repeat, lambda: encode_tree(records))
+    print(json.dumps({
+        'nodes': args.nodes,
+        'fanout': args.fanout,
+        'pydantic_ms': round(pydantic_time * 1000, 2),
+        'serializers_ms': round(fast_time * 1000, 2),
+        'speedup': round(pydantic_time / fast_time, 1),
+    }))
+
+
+if __name__ == '__main__':
+    main()
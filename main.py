@@ -1,5 +1,12 @@
+import logging
+
 import uvicorn
-from app.settings import SERVER_PORT
+from app.settings import SERVER_PORT, WORKERS, DB_POOL_MAX_SIZE
+
+logger = logging.getLogger(__name__)
+
 
 if __name__ == "__main__":
-    uvicorn.run("app.api:app", host="0.0.0.0", port=SERVER_PORT)
+    logger.info('Воркеров %s, соединений с базой на воркер до %s', WORKERS, DB_POOL_MAX_SIZE)
+    # loop/http auto: uvloop и httptools, если установлены
+    uvicorn.run("app.api:app", host="0.0.0.0", port=int(SERVER_PORT), workers=WORKERS, loop="auto", http="auto")
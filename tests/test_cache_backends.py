@@ -0,0 +1,67 @@
+"""Проверка Redis-частей кэша на fakeredis: python -m pytest tests"""
+import asyncio
+
+from fakeredis import FakeAsyncRedis, FakeServer
+
+from app.cache.backends import INVALIDATION_CHANNEL, MemoryBackend, RedisBackend
+
+
+async def eventually(condition, timeout: float = 2.0) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await condition():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+def test_redis_backend_rejects_stale_write():
+    async def run():
+        backend = RedisBackend(client=FakeAsyncRedis())
+        value, version = await backend.get('node:1')
+        assert value is None
+        # Инвалидация между чтением и записью: отрендеренное значение могло устареть
+        await backend.invalidate(['1'])
+        await backend.set('node:1', b'old', ['1'], version)
+        assert (await backend.get('node:1'))[0] is None
+
+        value, version = await backend.get('node:1')
+        await backend.set('node:1', b'new', ['1'], version)
+        assert (await backend.get('node:1'))[0] == b'new'
+
+        await backend.invalidate(['1'])
+        assert (await backend.get('node:1'))[0] is None
+        await backend.disconnect()
+
+    asyncio.run(run())
+
+
+def test_memory_backend_broadcasts_invalidation():
+    async def run():
+        server = FakeServer()
+        first = MemoryBackend(100, 1024 * 1024, client=FakeAsyncRedis(server=server))
+        second = MemoryBackend(100, 1024 * 1024, client=FakeAsyncRedis(server=server))
+        await first.connect()
+        await second.connect()
+        observer = FakeAsyncRedis(server=server)
+
+        async def subscribed() -> bool:
+            return dict(await observer.pubsub_numsub(INVALIDATION_CHANNEL)).get(INVALIDATION_CHANNEL.encode()) == 2
+        assert await eventually(subscribed)
+
+        _, version = await second.get('node:1')
+        await second.set('node:1', b'tree', ['1'], version)
+        _, version = await second.get('node:2')
+        await second.set('node:2', b'other', ['2'], version)
+        await first.invalidate(['1'])
+
+        async def dropped() -> bool:
+            return (await second.get('node:1'))[0] is None
+        assert await eventually(dropped)
+        assert (await second.get('node:2'))[0] == b'other'
+
+        await observer.close()
+        await first.disconnect()
+        await second.disconnect()
+
+    asyncio.run(run())